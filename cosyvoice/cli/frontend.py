@@ -12,7 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from functools import partial
-from typing import Generator
+from typing import Generator, List
+from concurrent.futures import ThreadPoolExecutor
 import json
 import onnxruntime
 import torch
@@ -23,6 +24,7 @@ import torchaudio.compliance.kaldi as kaldi
 import torchaudio
 import os
 import re
+import threading
 import inflect
 try:
     import ttsfrd
@@ -33,6 +35,7 @@ except ImportError:
     from wetext import Normalizer as EnNormalizer
     use_ttsfrd = False
 from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.cache_utils import LRUCache, PromptCache
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
 
 
@@ -44,7 +47,11 @@ class CosyVoiceFrontEnd:
                  campplus_model: str,
                  speech_tokenizer_model: str,
                  spk2info: str = '',
-                 allowed_special: str = 'all'):
+                 allowed_special: str = 'all',
+                 prompt_cache_size: int = 64,
+                 prompt_cache_dir: str = '',
+                 text_normalize_cache_size: int = 1024,
+                 text_normalize_workers: int = 4):
         self.tokenizer = get_tokenizer()
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -60,6 +67,11 @@ class CosyVoiceFrontEnd:
         else:
             self.spk2info = {}
         self.allowed_special = allowed_special
+        self.prompt_cache = PromptCache(prompt_cache_size, prompt_cache_dir, self.device)
+        self.text_normalize_cache = LRUCache(text_normalize_cache_size)
+        self.text_normalize_workers = text_normalize_workers
+        self.text_normalize_executor = None
+        self.text_normalize_lock = threading.Lock()
         self.use_ttsfrd = use_ttsfrd
         if self.use_ttsfrd:
             self.frd = ttsfrd.TtsFrontendEngine()
@@ -124,9 +136,29 @@ class CosyVoiceFrontEnd:
             return [text]
         if text_frontend is False or text == '':
             return [text] if split is True else text
+        # NOTE normalizer language is decided by the text itself, so text and split flag are enough as key
+        key = (text, split)
+        result = self.text_normalize_cache.get(key)
+        if result is None:
+            result = self._text_normalize(text, split)
+            self.text_normalize_cache.put(key, result)
+        return list(result) if split is True else result
+
+    def text_normalize_batch(self, texts: List[str], split=True, text_frontend=True):
+        """Normalize texts in a worker pool, returns results in the same order as texts."""
+        if self.text_normalize_workers <= 1 or len(texts) <= 1:
+            return [self.text_normalize(text, split=split, text_frontend=text_frontend) for text in texts]
+        with self.text_normalize_lock:
+            if self.text_normalize_executor is None:
+                self.text_normalize_executor = ThreadPoolExecutor(max_workers=self.text_normalize_workers)
+        return list(self.text_normalize_executor.map(partial(self.text_normalize, split=split, text_frontend=text_frontend), texts))
+
+    def _text_normalize(self, text, split):
         text = text.strip()
         if self.use_ttsfrd:
-            texts = [i["text"] for i in json.loads(self.frd.do_voicegen_frd(text))["sentences"]]
+            # NOTE ttsfrd engine is shared by all workers of text_normalize_batch
+            with self.text_normalize_lock:
+                texts = [i["text"] for i in json.loads(self.frd.do_voicegen_frd(text))["sentences"]]
             text = ''.join(texts)
         else:
             if contains_chinese(text):
@@ -146,7 +178,30 @@ class CosyVoiceFrontEnd:
                 texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "en", token_max_n=80,
                                              token_min_n=60, merge_len=20, comma_split=False))
         texts = [i for i in texts if not is_only_punctuation(i)]
-        return texts if split is True else text
+        return tuple(texts) if split is True else text
+
+    def _extract_prompt(self, prompt_text, prompt_speech_16k, resample_rate):
+        key = self.prompt_cache.get_key(prompt_text, prompt_speech_16k, resample_rate)
+        model_input = self.prompt_cache.get(key)
+        if model_input is not None:
+            return model_input
+        prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
+        prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
+        speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
+        speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
+        if resample_rate == 24000:
+            # cosyvoice2, force speech_feat % speech_token = 2
+            token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
+            speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
+            speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
+        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
+                       'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
+                       'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
+                       'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
+                       'llm_embedding': embedding, 'flow_embedding': embedding}
+        self.prompt_cache.put(key, model_input)
+        return dict(model_input)
 
     def frontend_sft(self, tts_text, spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
@@ -157,23 +212,9 @@ class CosyVoiceFrontEnd:
     def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, resample_rate, zero_shot_spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         if zero_shot_spk_id == '':
-            prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-            prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
-            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
-            speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
-            if resample_rate == 24000:
-                # cosyvoice2, force speech_feat % speech_token = 2
-                token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
-                speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
-                speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
-            embedding = self._extract_spk_embedding(prompt_speech_16k)
-            model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
-                           'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
-                           'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
-                           'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
-                           'llm_embedding': embedding, 'flow_embedding': embedding}
+            model_input = self._extract_prompt(prompt_text, prompt_speech_16k, resample_rate)
         else:
-            model_input = self.spk2info[zero_shot_spk_id]
+            model_input = dict(self.spk2info[zero_shot_spk_id])
         model_input['text'] = tts_text_token
         model_input['text_len'] = tts_text_token_len
         return model_input
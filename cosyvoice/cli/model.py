@@ -17,12 +17,11 @@ from typing import Generator
 import torch
 import numpy as np
 import threading
-import time
 from torch.nn import functional as F
 from contextlib import nullcontext
 import uuid
 from cosyvoice.utils.common import fade_in_out
-from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
+from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm, logging
 from cosyvoice.utils.common import TrtContextWrapper
 
 
@@ -60,6 +59,8 @@ class CosyVoiceModel:
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
+        self.llm_error_dict = {}
+        self.llm_cond_dict = {}
         self.mel_overlap_dict = {}
         self.flow_cache_dict = {}
         self.hift_cache_dict = {}
@@ -69,11 +70,39 @@ class CosyVoiceModel:
         self.llm.to(self.device).eval()
         self.flow.load_state_dict(torch.load(flow_model, map_location=self.device), strict=True)
         self.flow.to(self.device).eval()
+        self.load_hift(hift_model)
+
+    def load_hift(self, hift_model):
         # in case hift_model is a hifigan model
         hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device).items()}
         self.hift.load_state_dict(hift_state_dict, strict=True)
         self.hift.to(self.device).eval()
 
+    def load_quantize(self, llm_model, flow_model, llm_int8_model, flow_int8_model):
+        """Load llm and flow with dynamic int8 quantization of linear layers in llm, flow encoder and flow estimator for cpu inference.
+
+        Quantized state dicts are cached in llm_int8_model/flow_int8_model together with the mtime of their fp32 checkpoint.
+        A valid cache is loaded into the quantized modules directly, otherwise the fp32 checkpoint is loaded, quantized and cached.
+        """
+        assert self.device.type == 'cpu' and self.fp16 is False, 'int8 dynamic quantization only supports cpu fp32!'
+        from torch.ao.quantization import quantize_dynamic
+        for model, int8_model, module, quantized in [(llm_model, llm_int8_model, self.llm, [self.llm]),
+                                                     (flow_model, flow_int8_model, self.flow, [self.flow.encoder, self.flow.decoder.estimator])]:
+            source_mtime = os.path.getmtime(model)
+            cache = torch.load(int8_model, map_location=self.device) if os.path.exists(int8_model) and os.path.getsize(int8_model) != 0 else None
+            if cache is not None and cache.get('source_mtime') != source_mtime:
+                logging.info('{} does not match {}, quantize again'.format(int8_model, model))
+                cache = None
+            if cache is None:
+                module.load_state_dict(torch.load(model, map_location=self.device), strict=True)
+            for m in quantized:
+                quantize_dynamic(m, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+            if cache is None:
+                torch.save({'source_mtime': source_mtime, 'state_dict': module.state_dict()}, int8_model)
+            else:
+                module.load_state_dict(cache['state_dict'], strict=True)
+            module.to(self.device).eval()
+
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
         llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
         self.llm.text_encoder = llm_text_encoder
@@ -101,33 +130,58 @@ class CosyVoiceModel:
         return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
 
     def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
-            if isinstance(text, Generator):
-                assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
-                for i in self.llm.inference_bistream(text=text,
-                                                     prompt_text=prompt_text.to(self.device),
-                                                     prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                                     prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                                     prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                     embedding=llm_embedding.to(self.device)):
-                    self.tts_speech_token_dict[uuid].append(i)
-            else:
-                for i in self.llm.inference(text=text.to(self.device),
-                                            text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_text=prompt_text.to(self.device),
-                                            prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                            prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                            embedding=llm_embedding.to(self.device),
-                                            uuid=uuid):
-                    self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
+        try:
+            with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
+                if isinstance(text, Generator):
+                    assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
+                    for i in self.llm.inference_bistream(text=text,
+                                                         prompt_text=prompt_text.to(self.device),
+                                                         prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                         prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                         prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                         embedding=llm_embedding.to(self.device),
+                                                         uuid=uuid):
+                        with self.llm_cond_dict[uuid]:
+                            self.tts_speech_token_dict[uuid].append(i)
+                            self.llm_cond_dict[uuid].notify()
+                else:
+                    for i in self.llm.inference(text=text.to(self.device),
+                                                text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                                prompt_text=prompt_text.to(self.device),
+                                                prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                embedding=llm_embedding.to(self.device),
+                                                uuid=uuid):
+                        with self.llm_cond_dict[uuid]:
+                            self.tts_speech_token_dict[uuid].append(i)
+                            self.llm_cond_dict[uuid].notify()
+        except Exception as e:
+            # raised again by tts in the caller thread
+            logging.error('llm job of {} failed: {}'.format(uuid, e))
+            self.llm_error_dict[uuid] = e
+        finally:
+            with self.llm_cond_dict[uuid]:
+                self.llm_end_dict[uuid] = True
+                self.llm_cond_dict[uuid].notify()
 
     def vc_job(self, source_speech_token, uuid):
-        self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
-        self.llm_end_dict[uuid] = True
+        with self.llm_cond_dict[uuid]:
+            self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
+            self.llm_end_dict[uuid] = True
+            self.llm_cond_dict[uuid].notify()
+
+    def wait_speech_token(self, uuid, token_len):
+        # block until llm_job has generated token_len speech tokens or has finished
+        with self.llm_cond_dict[uuid]:
+            self.llm_cond_dict[uuid].wait_for(lambda: len(self.tts_speech_token_dict[uuid]) >= token_len or self.llm_end_dict[uuid] is True)
+        self.check_llm_error(uuid)
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
+    def check_llm_error(self, uuid):
+        if uuid in self.llm_error_dict:
+            raise self.llm_error_dict[uuid]
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0, n_timesteps=None, solver=None):
         with torch.cuda.amp.autocast(self.fp16):
             tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device),
                                                                       token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
@@ -136,7 +190,9 @@ class CosyVoiceModel:
                                                                       prompt_feat=prompt_feat.to(self.device),
                                                                       prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                                                       embedding=embedding.to(self.device),
-                                                                      flow_cache=self.flow_cache_dict[uuid])
+                                                                      flow_cache=self.flow_cache_dict[uuid],
+                                                                      n_timesteps=n_timesteps,
+                                                                      solver=solver)
 
         # mel overlap fade in out
         if self.mel_overlap_dict[uuid].shape[2] != 0:
@@ -171,11 +227,13 @@ class CosyVoiceModel:
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            n_timesteps=None, solver=None, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
         with self.lock:
             self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
+            self.llm_cond_dict[this_uuid] = threading.Condition()
             self.hift_cache_dict[this_uuid] = None
             self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
             self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
@@ -184,54 +242,68 @@ class CosyVoiceModel:
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
+        try:
+            if stream is True:
+                token_hop_len = self.token_min_hop_len
+                while True:
+                    self.wait_speech_token(this_uuid, token_hop_len + self.token_overlap_len)
+                    if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
+                        this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
+                            .unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         uuid=this_uuid,
+                                                         n_timesteps=n_timesteps,
+                                                         solver=solver,
+                                                         finalize=False)
+                        yield {'tts_speech': this_tts_speech.cpu()}
+                        with self.llm_cond_dict[this_uuid]:
+                            self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
+                        # increase token_hop_len for better speech quality
+                        token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
+                        break
+                p.join()
+                self.check_llm_error(this_uuid)
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 uuid=this_uuid,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver,
+                                                 finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                self.check_llm_error(this_uuid)
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 uuid=this_uuid,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # NOTE llm_job touches session dicts until it ends, also when the caller stops early or an error is raised
             p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
+            with self.lock:
+                self.tts_speech_token_dict.pop(this_uuid)
+                self.llm_end_dict.pop(this_uuid)
+                self.llm_error_dict.pop(this_uuid, None)
+                self.llm_cond_dict.pop(this_uuid)
+                self.mel_overlap_dict.pop(this_uuid)
+                self.hift_cache_dict.pop(this_uuid)
+                self.flow_cache_dict.pop(this_uuid)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -265,6 +337,8 @@ class CosyVoice2Model(CosyVoiceModel):
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
+        self.llm_error_dict = {}
+        self.llm_cond_dict = {}
         self.hift_cache_dict = {}
 
     def load_jit(self, flow_encoder_model):
@@ -282,18 +356,72 @@ class CosyVoice2Model(CosyVoiceModel):
         self.llm.lock = threading.Lock()
         del self.llm.llm.model.model.layers
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+    def load_scheduler(self, max_batch_size, num_kv_blocks=0, kv_block_size=16):
+        assert not hasattr(self.llm, 'vllm'), 'continuous batching scheduler do not support vllm!'
+        from cosyvoice.llm.scheduler import ContinuousBatchingScheduler
+        self.llm.scheduler = ContinuousBatchingScheduler(self.llm, max_batch_size=max_batch_size, fp16=self.fp16,
+                                                         num_kv_blocks=num_kv_blocks, kv_block_size=kv_block_size)
+
+    def load_draft(self, draft_llm, draft_llm_model, num_draft_tokens=4):
+        """Enable speculative decoding with draft_llm, a small TransformerLM sharing speech tokens and text tokenizer with llm."""
+        assert not hasattr(self.llm, 'vllm') and not hasattr(self.llm, 'scheduler'), 'speculative decoding do not support vllm or continuous batching!'
+        assert draft_llm.speech_token_size == self.llm.speech_token_size, 'draft llm must share speech tokens with llm!'
+        draft_llm.load_state_dict(torch.load(draft_llm_model, map_location=self.device), strict=True)
+        draft_llm.to(self.device).eval()
+        if self.fp16 is True:
+            draft_llm.half()
+        self.llm.draft = draft_llm
+        self.llm.num_draft_tokens = num_draft_tokens
+        self.llm.draft_stats = {'proposed': 0, 'accepted': 0, 'forward': 0}
+
+    def load_prefix_cache(self, max_size=64):
+        assert not hasattr(self.llm, 'vllm'), 'prefix kv cache do not support vllm!'
+        from cosyvoice.utils.cache_utils import LRUCache
+        self.llm.prefix_cache = LRUCache(max_size)
+
+    def load_pipeline(self, max_batch_size, queue_size=32):
+        from cosyvoice.cli.pipeline import Token2WavPipeline
+        self.pipeline = Token2WavPipeline(self, max_batch_size=max_batch_size, queue_size=queue_size)
+
+    def load_incremental_flow(self, num_decoding_left_chunks=4):
+        assert hasattr(self.flow.encoder, 'forward_chunk'), 'incremental flow do not support jit flow encoder!'
+        self.flow_num_decoding_left_chunks = num_decoding_left_chunks
+        self.flow_state_dict = {}
+
+    def load_stream_hift(self):
+        self.hift_state_dict = {}
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0, n_timesteps=None, solver=None):
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
-        tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+            if stream is True and hasattr(self, 'flow_state_dict'):
+                # only feed tokens after token_offset, encoder and history mel are cached in flow_state_dict
+                tts_mel, self.flow_state_dict[uuid] = self.flow.inference_incremental(token=token[:, token_offset:].to(self.device),
+                                                                                      prompt_token=prompt_token.to(self.device),
+                                                                                      prompt_feat=prompt_feat.to(self.device),
+                                                                                      embedding=embedding.to(self.device),
+                                                                                      finalize=finalize,
+                                                                                      flow_state=self.flow_state_dict[uuid],
+                                                                                      num_decoding_left_chunks=self.flow_num_decoding_left_chunks,
+                                                                                      n_timesteps=n_timesteps,
+                                                                                      solver=solver)
+            else:
+                tts_mel, _ = self.flow.inference(token=token.to(self.device),
+                                                 token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_token=prompt_token.to(self.device),
+                                                 prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_feat=prompt_feat.to(self.device),
+                                                 prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                 embedding=embedding.to(self.device),
+                                                 # NOTE the last chunk attends the full context
+                                                 streaming=stream and finalize is False,
+                                                 finalize=finalize,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver)
+                tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+        if hasattr(self, 'hift_state_dict') and speed == 1.0:
+            # hift caches its convolution contexts, source phase and istft overlap, every chunk only synthesizes new samples
+            tts_speech, self.hift_state_dict[uuid] = self.hift.inference_stream(speech_feat=tts_mel, hift_state=self.hift_state_dict[uuid], finalize=finalize)
+            return tts_speech
         # append hift cache
         if self.hift_cache_dict[uuid] is not None:
             hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
@@ -322,65 +450,97 @@ class CosyVoice2Model(CosyVoiceModel):
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            n_timesteps=None, solver=None, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
         with self.lock:
             self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
+            self.llm_cond_dict[this_uuid] = threading.Condition()
             self.hift_cache_dict[this_uuid] = None
+            if hasattr(self, 'flow_state_dict'):
+                self.flow_state_dict[this_uuid] = None
+            if hasattr(self, 'hift_state_dict'):
+                self.hift_state_dict[this_uuid] = None
         if source_speech_token.shape[1] == 0:
             p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     token_offset=token_offset,
-                                                     uuid=this_uuid,
-                                                     stream=stream,
-                                                     finalize=False)
-                    token_offset += this_token_hop_len
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
+        try:
+            if hasattr(self, 'pipeline'):
+                for this_tts_speech in self.pipeline.run(this_uuid, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream=stream, speed=speed,
+                                                         n_timesteps=n_timesteps, solver=solver):
+                    yield {'tts_speech': this_tts_speech}
+                p.join()
+                self.check_llm_error(this_uuid)
+            elif stream is True:
+                token_offset = 0
+                prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+                while True:
+                    this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
+                    self.wait_speech_token(this_uuid, token_offset + this_token_hop_len + self.flow.pre_lookahead_len)
+                    if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
+                        this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]) \
+                            .unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         token_offset=token_offset,
+                                                         uuid=this_uuid,
+                                                         n_timesteps=n_timesteps,
+                                                         solver=solver,
+                                                         stream=stream,
+                                                         finalize=False)
+                        token_offset += this_token_hop_len
+                        yield {'tts_speech': this_tts_speech.cpu()}
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
+                        break
+                p.join()
+                self.check_llm_error(this_uuid)
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=token_offset,
+                                                 uuid=this_uuid,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver,
+                                                 stream=stream,
+                                                 finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                self.check_llm_error(this_uuid)
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=0,
+                                                 uuid=this_uuid,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # NOTE llm_job touches session dicts until it ends, also when the caller stops early or an error is raised
             p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+            with self.lock:
+                self.tts_speech_token_dict.pop(this_uuid)
+                self.llm_end_dict.pop(this_uuid)
+                self.llm_error_dict.pop(this_uuid, None)
+                self.llm_cond_dict.pop(this_uuid)
+                self.hift_cache_dict.pop(this_uuid)
+                if hasattr(self, 'flow_state_dict'):
+                    self.flow_state_dict.pop(this_uuid)
+                if hasattr(self, 'hift_state_dict'):
+                    self.hift_state_dict.pop(this_uuid)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -0,0 +1,234 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+from collections import deque
+import numpy as np
+import torch
+from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
+from cosyvoice.utils.common import fade_in_out
+from cosyvoice.utils.file_utils import logging
+
+
+class PipelineSession:
+    """Flow/hift side state of one tts request, keyed by the same uuid as CosyVoice2Model session dicts."""
+
+    def __init__(self, uuid, prompt_token, prompt_feat, embedding, stream, speed, n_timesteps=None, solver=None):
+        self.uuid = uuid
+        self.prompt_token = prompt_token
+        self.prompt_feat = prompt_feat
+        self.embedding = embedding
+        self.stream = stream
+        self.speed = speed
+        self.n_timesteps = n_timesteps
+        self.solver = solver
+        self.hift_cache = None
+        self.failed = False
+        # set when the consumer of Token2WavPipeline.run stops iterating
+        self.abandoned = False
+        # speech chunks are put here in order, None means end of session
+        self.output_queue = queue.Queue()
+
+    @property
+    def active(self):
+        return self.failed is False and self.abandoned is False
+
+
+class PipelineJob:
+    """One chunk of a session, token is the speech token prefix to run flow on."""
+
+    def __init__(self, session, token, token_offset, finalize):
+        self.session = session
+        self.token = token
+        self.token_offset = token_offset
+        self.finalize = finalize
+        self.mel = None
+
+
+class Token2WavPipeline:
+    """Three stage LLM -> flow -> hift pipeline with bounded queues and one worker per stage.
+
+    The LLM stage is the existing llm_job thread of every session (batched by the continuous
+    batching scheduler if loaded). A dispatcher per session turns generated tokens into chunk jobs
+    on flow_queue, the flow worker runs inference_batch on all ready chunks of all sessions and
+    hands mels to hift_queue, the hift worker vocodes them and puts speech on session output queues.
+    When stages overlap, steady state throughput is bound by the slowest stage instead of their sum.
+    """
+
+    def __init__(self, model, max_batch_size: int = 8, queue_size: int = 32):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.flow_queue = queue.Queue(maxsize=queue_size)
+        self.hift_queue = queue.Queue(maxsize=queue_size)
+        self.flow_thread = threading.Thread(target=self.flow_loop, daemon=True)
+        self.flow_thread.start()
+        self.hift_thread = threading.Thread(target=self.hift_loop, daemon=True)
+        self.hift_thread.start()
+
+    def run(self, uuid, prompt_token, prompt_feat, embedding, stream=False, speed=1.0, n_timesteps=None, solver=None):
+        """Generator of speech chunks for session uuid, its llm_job must have been started."""
+        session = PipelineSession(uuid, prompt_token, prompt_feat, embedding, stream, speed, n_timesteps, solver)
+        threading.Thread(target=self.dispatch, args=(session,), daemon=True).start()
+        try:
+            while True:
+                speech = session.output_queue.get()
+                if speech is None:
+                    break
+                if isinstance(speech, Exception):
+                    raise speech
+                yield speech
+        finally:
+            # stop dispatching and drop queued chunks if the caller closed the generator early
+            session.abandoned = True
+
+    def dispatch(self, session):
+        model, uuid = self.model, session.uuid
+        try:
+            token_offset = 0
+            if session.stream is True:
+                prompt_token_pad = int(np.ceil(session.prompt_token.shape[1] / model.token_hop_len) * model.token_hop_len - session.prompt_token.shape[1])
+                while session.abandoned is False:
+                    this_token_hop_len = model.token_hop_len + prompt_token_pad if token_offset == 0 else model.token_hop_len
+                    model.wait_speech_token(uuid, token_offset + this_token_hop_len + model.flow.pre_lookahead_len)
+                    if len(model.tts_speech_token_dict[uuid]) - token_offset >= this_token_hop_len + model.flow.pre_lookahead_len:
+                        token = torch.tensor(model.tts_speech_token_dict[uuid][:token_offset + this_token_hop_len + model.flow.pre_lookahead_len]).unsqueeze(dim=0)
+                        self.flow_queue.put(PipelineJob(session, token, token_offset, finalize=False))
+                        token_offset += this_token_hop_len
+                    if model.llm_end_dict[uuid] is True and len(model.tts_speech_token_dict[uuid]) - token_offset < this_token_hop_len + model.flow.pre_lookahead_len:
+                        break
+            if session.abandoned is True:
+                return
+            model.wait_speech_token(uuid, float('inf'))
+            token = torch.tensor(model.tts_speech_token_dict[uuid]).unsqueeze(dim=0)
+            self.flow_queue.put(PipelineJob(session, token, token_offset, finalize=True))
+        except Exception as e:
+            session.failed = True
+            session.output_queue.put(e)
+
+    def get_jobs(self, job_queue, pending):
+        # block for the first job, then take whatever else is ready, pending never exceeds max_batch_size
+        # so that a slow stage still back pressures the previous one through the bounded queue
+        if len(pending) == 0:
+            pending.append(job_queue.get())
+        while len(pending) < self.max_batch_size:
+            try:
+                pending.append(job_queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def flow_loop(self):
+        pending = deque()
+        while True:
+            self.get_jobs(self.flow_queue, pending)
+            jobs = [pending.popleft() for _ in range(min(self.max_batch_size, len(pending)))]
+            jobs = [j for j in jobs if j.session.active]
+            # NOTE chunks of one session do not depend on each other in flow, but streaming/finalize/solver must be the same in one call,
+            # the last chunk of a stream session runs with full attention like the sequential path
+            groups = {}
+            for job in jobs:
+                groups.setdefault((job.session.stream is True and job.finalize is False, job.finalize, job.session.n_timesteps, job.session.solver), []).append(job)
+            for (streaming, finalize, n_timesteps, solver), group in groups.items():
+                try:
+                    self.flow_step(group, streaming, finalize, n_timesteps, solver)
+                except Exception as e:
+                    logging.error('pipeline flow step failed, abort {} sessions'.format(len(group)))
+                    self.abort(group, e)
+            # keep chunk order of every session when handing over to hift
+            for job in jobs:
+                if job.session.active:
+                    self.hift_queue.put(job)
+
+    def hift_loop(self):
+        pending = deque()
+        while True:
+            self.get_jobs(self.hift_queue, pending)
+            # NOTE chunk k + 1 needs the hift cache of chunk k, so take at most one chunk per session in one batch
+            jobs, uuids, rest = [], set(), deque()
+            while len(pending) != 0:
+                job = pending.popleft()
+                if job.session.uuid in uuids or len(jobs) == self.max_batch_size:
+                    rest.append(job)
+                else:
+                    uuids.add(job.session.uuid)
+                    jobs.append(job)
+            pending = rest
+            jobs = [j for j in jobs if j.session.active]
+            if len(jobs) == 0:
+                continue
+            try:
+                self.hift_step(jobs)
+            except Exception as e:
+                logging.error('pipeline hift step failed, abort {} sessions'.format(len(jobs)))
+                self.abort(jobs, e)
+
+    def abort(self, jobs, e):
+        for job in jobs:
+            if job.session.active:
+                job.session.failed = True
+                job.session.output_queue.put(e)
+
+    def flow_step(self, jobs, streaming, finalize, n_timesteps=None, solver=None):
+        model = self.model
+        token = pad_sequence([j.token.squeeze(dim=0) for j in jobs], batch_first=True, padding_value=0).to(model.device)
+        token_len = torch.tensor([j.token.shape[1] for j in jobs], dtype=torch.int32).to(model.device)
+        prompt_token = pad_sequence([j.session.prompt_token.squeeze(dim=0) for j in jobs], batch_first=True, padding_value=0).to(model.device)
+        prompt_token_len = torch.tensor([j.session.prompt_token.shape[1] for j in jobs], dtype=torch.int32).to(model.device)
+        prompt_feat = pad_sequence([j.session.prompt_feat.squeeze(dim=0) for j in jobs], batch_first=True, padding_value=0).to(model.device)
+        prompt_feat_len = torch.tensor([j.session.prompt_feat.shape[1] for j in jobs], dtype=torch.int32).to(model.device)
+        embedding = torch.concat([j.session.embedding.to(model.device) for j in jobs], dim=0)
+        with torch.cuda.amp.autocast(model.fp16):
+            tts_mels = model.flow.inference_batch(token=token,
+                                                  token_len=token_len,
+                                                  prompt_token=prompt_token,
+                                                  prompt_token_len=prompt_token_len,
+                                                  prompt_feat=prompt_feat,
+                                                  prompt_feat_len=prompt_feat_len,
+                                                  embedding=embedding,
+                                                  streaming=streaming,
+                                                  finalize=finalize,
+                                                  n_timesteps=n_timesteps,
+                                                  solver=solver)
+        for job, tts_mel in zip(jobs, tts_mels):
+            job.mel = tts_mel[:, :, job.token_offset * model.flow.token_mel_ratio:]
+
+    def hift_step(self, jobs):
+        model = self.model
+        tts_mels, cache_sources = [], []
+        for job in jobs:
+            tts_mel, hift_cache = job.mel, job.session.hift_cache
+            # append hift cache
+            if hift_cache is not None:
+                tts_mel = torch.concat([hift_cache['mel'], tts_mel], dim=2)
+                cache_sources.append(hift_cache['source'])
+            else:
+                cache_sources.append(torch.zeros(1, 1, 0))
+            if job.finalize is True and job.session.speed != 1.0:
+                assert hift_cache is None, 'speed change only support non-stream inference mode'
+                tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / job.session.speed), mode='linear')
+            tts_mels.append(tts_mel)
+        tts_speechs, tts_sources = model.hift.inference_batch(speech_feat=tts_mels, cache_source=cache_sources)
+        for job, tts_mel, tts_speech, tts_source in zip(jobs, tts_mels, tts_speechs, tts_sources):
+            session = job.session
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], model.speech_window)
+            # keep overlap mel and hift cache
+            if job.finalize is False:
+                session.hift_cache = {'mel': tts_mel[:, :, -model.mel_cache_len:],
+                                      'source': tts_source[:, :, -model.source_cache_len:],
+                                      'speech': tts_speech[:, -model.source_cache_len:]}
+                tts_speech = tts_speech[:, :-model.source_cache_len]
+            session.output_queue.put(tts_speech.cpu())
+            if job.finalize is True:
+                session.output_queue.put(None)
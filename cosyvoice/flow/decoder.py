@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import math
 from typing import Tuple
 import torch
 import torch.nn as nn
@@ -85,6 +86,82 @@ class CausalResnetBlock1D(ResnetBlock1D):
         self.block2 = CausalBlock1D(dim_out, dim_out)
 
 
+class ChunkAttnProcessor:
+    """Self attention of BasicTransformerBlock with scaled_dot_product_attention and no dense T x T bias.
+
+    attention_mask is the (batch_size, 1, time) key padding bias. With chunk_size > 0, frame i only
+    attends to frames of its own and previous chunks, queries are processed in blocks of whole chunks
+    against their key prefix, so the chunk bias of one block is at most block_size x time.
+    """
+
+    def __init__(self, block_size: int = 512):
+        self.block_size = block_size
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, chunk_size=0):
+        residual = hidden_states
+        batch_size, seq_len, _ = hidden_states.shape
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+        head_dim = key.size(-1) // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        if attention_mask is not None:
+            attention_mask = attention_mask.view(batch_size, 1, 1, -1).to(query.dtype)
+
+        if chunk_size <= 0:
+            hidden_states = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask)
+        else:
+            pos = torch.arange(key.size(2), device=query.device)
+            block_size = max(chunk_size, self.block_size // chunk_size * chunk_size)
+            outputs = []
+            for start in range(0, seq_len, block_size):
+                end = min(start + block_size, seq_len)
+                key_end = min(math.ceil(end / chunk_size) * chunk_size, key.size(2))
+                bias = mask_to_bias(pos[:key_end] < ((pos[start:end] // chunk_size + 1) * chunk_size).unsqueeze(1), query.dtype)
+                if attention_mask is not None:
+                    bias = bias + attention_mask[:, :, :, :key_end]
+                outputs.append(F.scaled_dot_product_attention(query[:, :, start:end], key[:, :, :key_end], value[:, :, :key_end],
+                                                              attn_mask=bias))
+            hidden_states = torch.concat(outputs, dim=2)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+class DecoderContext:
+    """Inputs of ConditionalDecoder.forward which do not change across the ODE steps of one solve.
+
+    Time embeddings of all t in t_span are computed in one batch, attention biases of every resolution
+    and the packed mu/spks/cond are computed by the first forward of every batch size and reused later.
+    Set t to the float value of the timestep before every forward, t outside t_span is embedded on demand.
+    """
+
+    def __init__(self, decoder, t_span):
+        self.decoder = decoder
+        self.dtype, self.device = t_span.dtype, t_span.device
+        self.time_emb = dict(zip(t_span.tolist(), decoder.embed_time(t_span)))
+        self.t = None
+        self.cache = {}
+
+    def time_embedding(self, batch_size):
+        if self.t not in self.time_emb:
+            self.time_emb[self.t] = self.decoder.embed_time(torch.tensor([self.t], dtype=self.dtype, device=self.device))[0]
+        return self.time_emb[self.t].unsqueeze(dim=0).expand(batch_size, -1)
+
+    def get(self, key, func):
+        if key not in self.cache:
+            self.cache[key] = func()
+        return self.cache[key]
+
+
 class ConditionalDecoder(nn.Module):
     def __init__(
         self,
@@ -207,7 +284,22 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+    def embed_time(self, t):
+        return self.time_mlp(self.time_embeddings(t).to(t.dtype))
+
+    def attn_bias(self, x, mask):
+        # (batch_size, 1, time) key padding bias, broadcast over queries inside the attention
+        attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, 0, -1)
+        return mask_to_bias(attn_mask, x.dtype)
+
+    def attn_kwargs(self, streaming=False):
+        return None
+
+    def init_context(self, t_span):
+        """DecoderContext of one ODE solve over t_span, passed to every forward of the solve."""
+        return DecoderContext(self, t_span)
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False, context=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -216,6 +308,8 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            context (DecoderContext, optional): from init_context, mask/mu/spks/cond must be the same
+                in all forwards of the same batch size sharing it, and context.t is the value of t.
 
         Raises:
             ValueError: _description_
@@ -224,31 +318,32 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
-
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
-
-        x = pack([x, mu], "b * t")[0]
-
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+        if context is None:
+            t = self.embed_time(t)
+            x = pack([x, self.pack_cond(x, mu, spks, cond)], "b * t")[0]
+        else:
+            t = context.time_embedding(x.size(0))
+            x = pack([x, context.get(('cond', x.size(0)), lambda: self.pack_cond(x, mu, spks, cond))], "b * t")[0]
+
+        def attn_bias(level, x, mask):
+            if context is None:
+                return self.attn_bias(x, mask)
+            return context.get((level, x.size(0), x.dtype), lambda: self.attn_bias(x, mask))
+        attn_kwargs = self.attn_kwargs(streaming)
 
         hiddens = []
         masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
+        for i, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
             mask_down = masks[-1]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = attn_bias(i, x, mask_down)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
                     attention_mask=attn_mask,
                     timestep=t,
+                    cross_attention_kwargs=attn_kwargs,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
@@ -260,13 +355,13 @@ class ConditionalDecoder(nn.Module):
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = attn_bias(len(masks) - 1, x, mask_mid)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
                     attention_mask=attn_mask,
                     timestep=t,
+                    cross_attention_kwargs=attn_kwargs,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
 
@@ -276,13 +371,13 @@ class ConditionalDecoder(nn.Module):
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = attn_bias(len(masks), x, mask_up)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
                     attention_mask=attn_mask,
                     timestep=t,
+                    cross_attention_kwargs=attn_kwargs,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
             x = upsample(x * mask_up)
@@ -290,6 +385,16 @@ class ConditionalDecoder(nn.Module):
         output = self.final_proj(x * mask_up)
         return output * mask
 
+    def pack_cond(self, x, mu, spks, cond):
+        # mu, spks repeated over time and cond, concatenated to x along channels
+        h = mu
+        if spks is not None:
+            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
+            h = pack([h, spks], "b * t")[0]
+        if cond is not None:
+            h = pack([h, cond], "b * t")[0]
+        return h
+
 
 class CausalConditionalDecoder(ConditionalDecoder):
     def __init__(
@@ -401,94 +506,9 @@ class CausalConditionalDecoder(ConditionalDecoder):
         self.final_block = CausalBlock1D(channels[-1], channels[-1])
         self.final_proj = nn.Conv1d(channels[-1], self.out_channels, 1)
         self.initialize_weights()
+        for block in self.modules():
+            if isinstance(block, BasicTransformerBlock):
+                block.attn1.set_processor(ChunkAttnProcessor())
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
-        """Forward pass of the UNet1DConditional model.
-
-        Args:
-            x (torch.Tensor): shape (batch_size, in_channels, time)
-            mask (_type_): shape (batch_size, 1, time)
-            t (_type_): shape (batch_size)
-            spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
-            cond (_type_, optional): placeholder for future use. Defaults to None.
-
-        Raises:
-            ValueError: _description_
-            ValueError: _description_
-
-        Returns:
-            _type_: _description_
-        """
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
-
-        x = pack([x, mu], "b * t")[0]
-
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
-
-        hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
-            x = resnet(x, mask_down, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-            hiddens.append(x)  # Save hidden states for skip connections
-            x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
-
-        for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
-            skip = hiddens.pop()
-            x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
-            x = resnet(x, mask_up, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-            x = upsample(x * mask_up)
-        x = self.final_block(x, mask_up)
-        output = self.final_proj(x * mask_up)
-        return output * mask
+    def attn_kwargs(self, streaming=False):
+        return {'chunk_size': self.static_chunk_size if streaming is True else 0}
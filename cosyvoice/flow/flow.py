@@ -17,6 +17,7 @@ from typing import Dict, Optional
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 from omegaconf import DictConfig
 from cosyvoice.utils.mask import make_pad_mask
 
@@ -110,7 +111,9 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=None,
+                  solver=None):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -139,14 +142,72 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            cache=flow_cache
+            cache=flow_cache,
+            solver=solver
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), flow_cache
 
+    @torch.inference_mode()
+    def inference_batch(self,
+                        token,
+                        token_len,
+                        prompt_token,
+                        prompt_token_len,
+                        prompt_feat,
+                        prompt_feat_len,
+                        embedding,
+                        n_timesteps=None,
+                        solver=None):
+        """Batched non-stream inference.
+
+        token/prompt_token/prompt_feat are right padded, each item is described by its *_len.
+        Returns a list of mel (1, 80, mel_len2) for every item.
+        NOTE GroupNorm in estimator sees the padded part, so results may differ slightly from inference.
+        """
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # concat speech token and prompt speech token of every item
+        token_len1, token_len2 = prompt_token_len.tolist(), token_len.tolist()
+        token = pad_sequence([torch.concat([prompt_token[i, :token_len1[i]], token[i, :token_len2[i]]], dim=0) for i in range(token.shape[0])],
+                             batch_first=True, padding_value=0)
+        token_len = prompt_token_len + token_len
+        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+
+        # text encode
+        h, h_lengths = self.encoder(token, token_len)
+        h = self.encoder_proj(h)
+        # NOTE length_regulator contains GroupNorm, so regulate item by item to avoid padding in its statistics
+        mel_len1 = prompt_feat_len.tolist()
+        mel_len2 = [int(i / self.input_frame_rate * 22050 / 256) for i in token_len2]
+        h = pad_sequence([self.length_regulator.inference(h[i:i + 1, :token_len1[i]], h[i:i + 1, token_len1[i]:token_len1[i] + token_len2[i]],
+                                                          mel_len1[i], mel_len2[i], self.input_frame_rate)[0].squeeze(dim=0)
+                          for i in range(h.shape[0])], batch_first=True, padding_value=0)
+
+        # get conditions
+        conds = torch.zeros([h.shape[0], h.shape[1], self.output_size], device=token.device).to(h.dtype)
+        for i in range(h.shape[0]):
+            conds[i, :mel_len1[i]] = prompt_feat[i, :mel_len1[i]]
+        conds = conds.transpose(1, 2)
+
+        mel_len = torch.tensor([i + j for i, j in zip(mel_len1, mel_len2)], device=h.device)
+        mask = (~make_pad_mask(mel_len, h.shape[1])).to(h)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            solver=solver
+        )
+        return [feat[i:i + 1, :, mel_len1[i]:mel_len1[i] + mel_len2[i]].float() for i in range(feat.shape[0])]
+
 
 class CausalMaskedDiffWithXvec(torch.nn.Module):
     def __init__(self,
@@ -242,7 +303,9 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  n_timesteps=None,
+                  solver=None):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -273,9 +336,149 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), None
+
+    @torch.inference_mode()
+    def inference_incremental(self,
+                              token,
+                              prompt_token,
+                              prompt_feat,
+                              embedding,
+                              finalize,
+                              flow_state=None,
+                              num_decoding_left_chunks=-1,
+                              n_timesteps=None,
+                              solver=None):
+        """Streaming inference that only encodes and denoises the new tokens of this chunk.
+
+        token holds the new tokens only, followed by pre_lookahead_len lookahead tokens when finalize is False.
+        flow_state is returned by the previous chunk, None for the first chunk.
+        The encoder keeps its attention/conv caches in flow_state, so every token is encoded once.
+        The estimator has no cache, its input is prompt + left context + new chunk:
+            num_decoding_left_chunks < 0: all previous frames are left context, the result equals inference(streaming=True)
+            num_decoding_left_chunks >= 0: at most that many decoder chunks of previous frames are left context,
+                they are passed as cond together with the prompt feat, so per chunk cost does not grow with utterance length
+        NOTE every chunk except the last one must end at a multiple of encoder static_chunk_size, including the prompt,
+            which is how CosyVoice2Model.tts splits tokens.
+        """
+        assert token.shape[0] == 1
+        if flow_state is None:
+            token = torch.concat([prompt_token, token], dim=1)
+        if finalize is False:
+            token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
+        else:
+            context = token[:, :0]
+        if flow_state is None:
+            # xvec projection
+            embedding = F.normalize(embedding, dim=1)
+            embedding = self.spk_embed_affine_layer(embedding)
+            flow_state = {'embedding': embedding, 'encoder': None, 'mu': None, 'mel': None}
+        embedding = flow_state['embedding']
+        if token.shape[1] == 0:
+            return torch.zeros(1, self.output_size, 0, device=token.device), flow_state
+
+        # text encode
+        token, context = self.input_embedding(torch.clamp(token, min=0)), self.input_embedding(torch.clamp(context, min=0))
+        h, flow_state['encoder'] = self.encoder.forward_chunk(token, context=context, cache=flow_state['encoder'])
+        h = self.encoder_proj(h)
+        mu = flow_state['mu'] = h if flow_state['mu'] is None else torch.concat([flow_state['mu'], h], dim=1)
+        mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1]
+        # previous frames generated by this session
+        mel_len_prev = mu.shape[1] - mel_len1 - mel_len2
+
+        chunk_size = self.encoder.static_chunk_size * self.token_mel_ratio
+        context_len = num_decoding_left_chunks * chunk_size + (-mel_len1) % chunk_size
+        if num_decoding_left_chunks < 0 or mel_len_prev <= context_len:
+            # get conditions
+            conds = torch.zeros([1, mu.shape[1], self.output_size], device=token.device).to(h.dtype)
+            conds[:, :mel_len1] = prompt_feat
+            noise = None
+        else:
+            # NOTE start of the new chunk is still aligned to chunk_size, noise is taken at the absolute frame index
+            mu = torch.concat([mu[:, :mel_len1], mu[:, -context_len - mel_len2:]], dim=1)
+            conds = torch.zeros([1, mu.shape[1], self.output_size], device=token.device).to(h.dtype)
+            conds[:, :mel_len1] = prompt_feat
+            conds[:, mel_len1:mel_len1 + context_len] = flow_state['mel'][:, :, -context_len:].transpose(1, 2)
+            rand_noise = self.decoder.rand_noise
+            noise = torch.concat([rand_noise[:, :, :mel_len1], rand_noise[:, :, mel_len1 + mel_len_prev - context_len: mel_len1 + mel_len_prev + mel_len2]], dim=2)
+        conds = conds.transpose(1, 2)
+
+        mask = torch.ones(1, 1, mu.shape[1], device=token.device).to(h)
+        feat, _ = self.decoder(
+            mu=mu.transpose(1, 2).contiguous(),
+            mask=mask,
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            streaming=True,
+            solver=solver,
+            noise=noise
+        )
+        feat = feat[:, :, -mel_len2:]
+        if num_decoding_left_chunks >= 0:
+            mel = feat if flow_state['mel'] is None else torch.concat([flow_state['mel'], feat], dim=2)
+            flow_state['mel'] = mel[:, :, -(context_len + chunk_size):]
+        return feat.float(), flow_state
+
+    @torch.inference_mode()
+    def inference_batch(self,
+                        token,
+                        token_len,
+                        prompt_token,
+                        prompt_token_len,
+                        prompt_feat,
+                        prompt_feat_len,
+                        embedding,
+                        streaming,
+                        finalize,
+                        n_timesteps=None,
+                        solver=None):
+        """Batched inference, all items run their cfg twins in one estimator call per step.
+
+        token/prompt_token/prompt_feat are right padded, each item is described by its *_len.
+        Returns a list of mel (1, 80, mel_len2) for every item.
+        The estimator runs at batch 2 * B, a trt estimator built with a fixed batch of 2 only supports B = 1.
+        """
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # concat text and prompt_text of every item
+        token_len1, token_len2 = prompt_token_len.tolist(), token_len.tolist()
+        token = pad_sequence([torch.concat([prompt_token[i, :token_len1[i]], token[i, :token_len2[i]]], dim=0) for i in range(token.shape[0])],
+                             batch_first=True, padding_value=0)
+        token_len = prompt_token_len + token_len
+        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+
+        # text encode
+        # NOTE when finalize is False, lookahead tokens are kept in place instead of passed as context,
+        # pre_lookahead_layer still sees them while attention masks them out by length
+        h, h_masks = self.encoder(token, token_len if finalize is True else token_len - self.pre_lookahead_len, streaming=streaming)
+        h_lengths = h_masks.sum(dim=-1).squeeze(dim=1)
+        h = self.encoder_proj(h)
+        mel_len1, mel_len = prompt_feat_len.tolist(), h_lengths.tolist()
+
+        # get conditions
+        conds = torch.zeros([h.shape[0], h.shape[1], self.output_size], device=token.device).to(h.dtype)
+        for i in range(h.shape[0]):
+            conds[i, :mel_len1[i]] = prompt_feat[i, :mel_len1[i]]
+        conds = conds.transpose(1, 2)
+
+        mask = (~make_pad_mask(h_lengths, h.shape[1])).to(h)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver
+        )
+        return [feat[i:i + 1, :, mel_len1[i]:mel_len[i]].float() for i in range(feat.shape[0])]
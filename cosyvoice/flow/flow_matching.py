@@ -18,6 +18,85 @@ from matcha.models.components.flow_matching import BASECFM
 from cosyvoice.utils.common import set_all_random_seed
 
 
+def euler_solver(velocity, x, t_span):
+    """First order, one nfe per interval of t_span."""
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        x = x + dt * velocity(x, t)
+    return x
+
+
+def midpoint_solver(velocity, x, t_span):
+    """Second order, two nfe per interval of t_span."""
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        x_mid = x + 0.5 * dt * velocity(x, t)
+        x = x + dt * velocity(x_mid, t + 0.5 * dt)
+    return x
+
+
+def heun_solver(velocity, x, t_span):
+    """Second order (RK2 trapezoid), two nfe per interval of t_span."""
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        v = velocity(x, t)
+        v_next = velocity(x + dt * v, t + dt)
+        x = x + 0.5 * dt * (v + v_next)
+    return x
+
+
+def adams_bashforth2_solver(velocity, x, t_span):
+    """Variable step two step Adams-Bashforth on the velocity, one nfe per interval of t_span.
+
+    The velocity of the previous step is linearly extrapolated over the current interval,
+    the first step falls back to euler.
+    """
+    v_prev, dt_prev = None, None
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        v = velocity(x, t)
+        if v_prev is None:
+            x = x + dt * v
+        else:
+            r = dt / dt_prev
+            x = x + dt * ((1 + 0.5 * r) * v - 0.5 * r * v_prev)
+        v_prev, dt_prev = v, dt
+    return x
+
+
+def adaptive_solver(velocity, x, t_span, rtol=0.05, atol=0.05):
+    """Heun-Euler embedded pair with step size control.
+
+    The first interval of t_span is the initial step size, the nfe budget is the
+    same as heun_solver on t_span, the last step is forced to reach t_span[-1].
+    """
+    t, t_end, dt = t_span[0].item(), t_span[-1].item(), (t_span[1] - t_span[0]).item()
+    max_nfe, nfe, v = 2 * (len(t_span) - 1), 0, None
+    while t_end - t > 1e-6:
+        last = nfe + 4 > max_nfe
+        dt = t_end - t if last else min(dt, t_end - t)
+        if v is None:
+            v = velocity(x, t)
+            nfe += 1
+        x_euler = x + dt * v
+        v_next = velocity(x_euler, t + dt)
+        nfe += 1
+        x_heun = x + 0.5 * dt * (v + v_next)
+        err = ((x_heun - x_euler) / (atol + rtol * x_heun.abs())).float().pow(2).mean().sqrt().item()
+        if err <= 1.0 or last:
+            x, t, v = x_heun, t + dt, None
+        dt = dt * min(2.0, max(0.2, 0.9 * (err + 1e-8) ** -0.5))
+    return x
+
+
+# NOTE every solver takes velocity(x, t) and t_span, cfm_params.solver is one of the keys
+ODE_SOLVERS = {'euler': euler_solver,
+               'midpoint': midpoint_solver,
+               'heun': heun_solver,
+               'ab2': adams_bashforth2_solver,
+               'adaptive': adaptive_solver}
+
+
 class ConditionalCFM(BASECFM):
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
         super().__init__(
@@ -29,12 +108,19 @@ class ConditionalCFM(BASECFM):
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
+        # default number of solver intervals, overridable per call
+        self.n_timesteps = cfm_params.get('n_timesteps', 10)
+        # guidance schedule, cfg is applied only when t is inside inference_cfg_interval,
+        # and the unconditional prediction is reused for inference_cfg_reuse_steps estimator calls.
+        # inference_cfg_rate 0 turns cfg off. Skipped cfg runs the estimator on the conditional batch only
+        self.inference_cfg_interval = tuple(cfm_params.get('inference_cfg_interval', (0.0, 1.0)))
+        self.inference_cfg_reuse_steps = cfm_params.get('inference_cfg_reuse_steps', 0)
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps=None, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2), solver=None):
         """Forward diffusion
 
         Args:
@@ -42,11 +128,12 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, n_feats, mel_timesteps)
             mask (torch.Tensor): output_mask
                 shape: (batch_size, 1, mel_timesteps)
-            n_timesteps (int): number of diffusion steps
+            n_timesteps (int, optional): number of solver intervals. Defaults to cfm_params.n_timesteps or 10.
             temperature (float, optional): temperature for scaling noise. Defaults to 1.0.
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): key of ODE_SOLVERS. Defaults to cfm_params.solver.
 
         Returns:
             sample: generated mel-spectrogram
@@ -63,10 +150,34 @@ class ConditionalCFM(BASECFM):
         mu_cache = torch.concat([mu[:, :, :prompt_len], mu[:, :, -34:]], dim=2)
         cache = torch.stack([z_cache, mu_cache], dim=-1)
 
+        n_timesteps = self.n_timesteps if n_timesteps is None else n_timesteps
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), cache
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver), cache
+
+    def solve(self, x, t_span, mu, mask, spks, cond, streaming=False, solver=None):
+        """
+        Solve the ODE from noise x to mel with the solver registered in ODE_SOLVERS.
+        Args:
+            x (torch.Tensor): random noise
+            t_span (torch.Tensor): n_timesteps interpolated
+                shape: (n_timesteps + 1,)
+            mu (torch.Tensor): output of encoder
+                shape: (batch_size, n_feats, mel_timesteps)
+            mask (torch.Tensor): output_mask
+                shape: (batch_size, 1, mel_timesteps)
+            spks (torch.Tensor, optional): speaker ids. Defaults to None.
+                shape: (batch_size, spk_emb_dim)
+            cond: Not used but kept for future purposes
+            solver (str, optional): key of ODE_SOLVERS. Defaults to cfm_params.solver.
+        """
+        solver = self.solver if solver is None else solver
+        if solver not in ODE_SOLVERS:
+            raise ValueError('unknown ode solver {}, available {}'.format(solver, list(ODE_SOLVERS.keys())))
+        velocity = self.cfg_velocity(mu, mask, spks, cond, streaming=streaming, t_span=t_span)
+        # NOTE solvers step over t_span on cpu, so that looking up precomputed time embeddings by t needs no device sync
+        return ODE_SOLVERS[solver](velocity, x, t_span.cpu()).float()
 
     def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
         """
@@ -83,59 +194,76 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
+        return self.solve(x, t_span, mu, mask, spks, cond, streaming=streaming, solver='euler')
 
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+    def cfg_velocity(self, mu, mask, spks, cond, streaming=False, t_span=None):
+        """Return velocity(x, t), the classifier-free guided dphi_dt.
 
+        Every call is one estimator forward, of batch 2 * b when the unconditional twins are computed,
+        of batch b when cfg is skipped by the guidance schedule or the cached unconditional prediction is reused.
+        If t_span is given, masks and time embeddings of the torch estimator are shared by all calls through its context.
+        """
+        b = mu.size(0)
+        cfg_rate, (cfg_t_min, cfg_t_max), reuse_steps = self.inference_cfg_rate, self.inference_cfg_interval, self.inference_cfg_reuse_steps
+        # NOTE trt engine is built with a fixed batch of 2, so it always runs the unconditional twins
+        shrink = isinstance(self.estimator, torch.nn.Module)
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        for step in range(1, len(t_span)):
+        # NOTE first b items are conditional, last b items are their unconditional cfg twins
+        x_in = torch.zeros([2 * b, 80, mu.size(2)], device=mu.device, dtype=mu.dtype)
+        mask_in = torch.zeros([2 * b, 1, mu.size(2)], device=mu.device, dtype=mu.dtype)
+        mu_in = torch.zeros([2 * b, 80, mu.size(2)], device=mu.device, dtype=mu.dtype)
+        t_in = torch.zeros([2 * b], device=mu.device, dtype=mu.dtype)
+        spks_in = torch.zeros([2 * b, 80], device=mu.device, dtype=mu.dtype)
+        cond_in = torch.zeros([2 * b, 80, mu.size(2)], device=mu.device, dtype=mu.dtype)
+        # last unconditional prediction and the number of calls it has been reused for
+        cache = {'cfg_dphi_dt': None, 'reused': 0}
+        context = self.estimator.init_context(t_span) if shrink and t_span is not None else None
+
+        def velocity(x, t):
+            guided = cfg_rate > 0 and ((cfg_t_min <= 0 and cfg_t_max >= 1) or cfg_t_min <= float(t) <= cfg_t_max)
+            reuse = shrink and guided and cache['cfg_dphi_dt'] is not None and cache['reused'] < reuse_steps
+            n = b if shrink and (not guided or reuse) else 2 * b
             # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
+            x_in[:b], x_in[b:] = x, x
+            mask_in[:b], mask_in[b:] = mask, mask
+            mu_in[:b] = mu
+            t_in[:] = t
+            spks_in[:b] = spks
+            cond_in[:b] = cond
+            if context is not None:
+                context.t = float(t)
             dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in,
-                streaming
+                x_in[:n], mask_in[:n],
+                mu_in[:n], t_in[:n],
+                spks_in[:n],
+                cond_in[:n],
+                streaming,
+                context
             )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+            if not guided:
+                # NOTE trt writes its output into x_in, do not hand out the buffer
+                return dphi_dt[:b].clone()
+            if reuse:
+                cache['reused'] += 1
+            else:
+                cache['cfg_dphi_dt'], cache['reused'] = dphi_dt[b:].clone(), 0
+            return (1.0 + cfg_rate) * dphi_dt[:b] - cfg_rate * cache['cfg_dphi_dt']
+        return velocity
 
-        return sol[-1].float()
-
-    def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
+    def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False, context=None):
         if isinstance(self.estimator, torch.nn.Module):
-            return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
+            return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming, context=context)
         else:
             [estimator, stream], trt_engine = self.estimator.acquire_estimator()
             # NOTE need to synchronize when switching stream
             torch.cuda.current_stream().synchronize()
             with stream:
-                estimator.set_input_shape('x', (2, 80, x.size(2)))
-                estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                estimator.set_input_shape('t', (2,))
-                estimator.set_input_shape('spks', (2, 80))
-                estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('t', (x.size(0),))
+                estimator.set_input_shape('spks', (x.size(0), 80))
+                estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 data_ptrs = [x.contiguous().data_ptr(),
                              mask.contiguous().data_ptr(),
                              mu.contiguous().data_ptr(),
@@ -200,7 +328,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False):
+    def forward(self, mu, mask, n_timesteps=None, temperature=1.0, spks=None, cond=None, streaming=False, solver=None, noise=None):
         """Forward diffusion
 
         Args:
@@ -208,20 +336,27 @@ class CausalConditionalCFM(ConditionalCFM):
                 shape: (batch_size, n_feats, mel_timesteps)
             mask (torch.Tensor): output_mask
                 shape: (batch_size, 1, mel_timesteps)
-            n_timesteps (int): number of diffusion steps
+            n_timesteps (int, optional): number of solver intervals. Defaults to cfm_params.n_timesteps or 10.
             temperature (float, optional): temperature for scaling noise. Defaults to 1.0.
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): key of ODE_SOLVERS. Defaults to cfm_params.solver.
+            noise (torch.Tensor, optional): initial noise. Defaults to the prefix of the fixed rand_noise.
+                shape: (batch_size, n_feats, mel_timesteps)
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        if noise is None:
+            # NOTE items in a batch are right padded, so every item shares the same noise as in single item inference
+            noise = self.rand_noise[:, :, :mu.size(2)].repeat(mu.size(0), 1, 1)
+        z = noise.to(mu.device).to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
+        n_timesteps = self.n_timesteps if n_timesteps is None else n_timesteps
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, solver=solver), None
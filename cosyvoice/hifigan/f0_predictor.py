@@ -56,3 +56,10 @@ class ConvRNNF0Predictor(nn.Module):
         x = self.condnet(x)
         x = x.transpose(1, 2)
         return torch.abs(self.classifier(x).squeeze(-1))
+
+    def forward_stream(self, x: torch.Tensor, stream) -> torch.Tensor:
+        """forward of a chunk, the convolution caches are kept in stream (HiFTStream)."""
+        for i, layer in enumerate(self.condnet):
+            x = stream.conv('f0_predictor.condnet.{}'.format(i), layer, x) if isinstance(layer, nn.Conv1d) else layer(x)
+        x = x.transpose(1, 2)
+        return torch.abs(self.classifier(x).squeeze(-1))
@@ -14,7 +14,7 @@
 
 """HIFI-GAN"""
 
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple
 import numpy as np
 from scipy.signal import get_window
 import torch
@@ -23,6 +23,7 @@ import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
 from torch.nn.utils import remove_weight_norm
+from torch.nn.utils.rnn import pad_sequence
 try:
     from torch.nn.utils.parametrizations import weight_norm
 except ImportError:
@@ -43,6 +44,162 @@ This code is modified from https://github.com/jik876/hifi-gan
 """
 
 
+class STFT(nn.Module):
+    """stft/istft of HiFTGenerator with a periodic hann window.
+
+    The window and the windowed inverse dft basis are non persistent buffers, they move with the module once
+    and are not in the state dict. istft takes the conv_post output directly, magnitude is exp of the first
+    n_fft // 2 + 1 channels clipped to 1e2 and phase is sin of the others. With conv_istft, the inverse is a
+    conv_transpose1d of the basis on real and imaginary parts instead of torch.istft on a complex tensor,
+    which is real valued and exports to onnx/jit.
+    """
+
+    def __init__(self, n_fft: int, hop_len: int, conv_istft: bool = False):
+        super(STFT, self).__init__()
+        self.n_fft = n_fft
+        self.hop_len = hop_len
+        self.conv_istft = conv_istft
+        window = torch.from_numpy(get_window("hann", n_fft, fftbins=True).astype(np.float32))
+        self.register_buffer('window', window, persistent=False)
+        # irfft of a onesided spectrum, imaginary parts of dc and nyquist are ignored as their sin terms are 0
+        angle = 2 * np.pi * torch.arange(n_fft // 2 + 1).unsqueeze(1) * torch.arange(n_fft).unsqueeze(0) / n_fft
+        scale = torch.full((n_fft // 2 + 1, 1), 2.0)
+        scale[0], scale[-1] = 1.0, 2.0 if n_fft % 2 == 1 else 1.0
+        basis = torch.concat([scale * torch.cos(angle), -scale * torch.sin(angle)], dim=0) / n_fft * window
+        self.register_buffer('istft_basis', basis.unsqueeze(1), persistent=False)  # (n_fft + 2, 1, n_fft)
+
+    def stft(self, x: torch.Tensor, center: bool = True) -> Tuple[torch.Tensor, torch.Tensor]:
+        spec = torch.stft(x, self.n_fft, self.hop_len, self.n_fft, window=self.window, center=center, return_complex=True)
+        spec = torch.view_as_real(spec)  # [B, F, TT, 2]
+        return spec[..., 0], spec[..., 1]
+
+    def polar(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # clipping before exp saves one full size temporary, exp_ is autograd safe
+        magnitude = torch.clamp(x[:, :self.n_fft // 2 + 1, :], max=np.log(1e2)).exp_()
+        phase = torch.sin(x[:, self.n_fft // 2 + 1:, :])  # actually, sin is redundancy
+        return magnitude, phase
+
+    def spec(self, x: torch.Tensor) -> torch.Tensor:
+        # real and imaginary parts concatenated on channels, the input of conv_istft
+        magnitude, phase = self.polar(x)
+        return torch.concat([magnitude * torch.cos(phase), magnitude * torch.sin(phase)], dim=1)
+
+    def frames(self, x: torch.Tensor) -> torch.Tensor:
+        """Windowed inverse dft of every frame of conv_post output x, (B, n_fft, TT) before overlap add."""
+        if self.conv_istft is True:
+            return torch.matmul(self.istft_basis[:, 0].t(), self.spec(x))
+        return torch.fft.irfft(torch.polar(*self.polar(x)), self.n_fft, dim=1) * self.window.unsqueeze(1)
+
+    def istft(self, x: torch.Tensor) -> torch.Tensor:
+        """torch.istft(center=True) of conv_post output x, (B, (TT - 1) * hop_len)."""
+        if self.conv_istft is False:
+            return torch.istft(torch.polar(*self.polar(x)), self.n_fft, self.hop_len, self.n_fft, window=self.window)
+        y = F.conv_transpose1d(self.spec(x), self.istft_basis, stride=self.hop_len)
+        envelope = F.conv_transpose1d(torch.ones_like(x[:1, :1]), self.window.pow(2).view(1, 1, -1), stride=self.hop_len)
+        return (y / envelope)[:, 0, self.n_fft // 2: y.size(2) - self.n_fft // 2]
+
+
+class HiFTStream:
+    """Caches of HiFTGenerator.inference_stream, one per utterance.
+
+    Every intermediate signal is a stream starting at frame 0 of the whole utterance. A convolution keeps the
+    input frames its next outputs still need and only outputs frames whose receptive field has fully arrived,
+    its padding is added at the first call (left) and at the finalize call (right), so the concatenation of
+    all outputs equals the non-streaming result. Branches of different delays are joined frame by frame in
+    align/add, frames only one branch has reached are kept until the other branch catches up.
+    """
+
+    def __init__(self):
+        self.finalize = False
+        self.cache = {}
+
+    def window(self, key, x, kernel_size, stride=1, padding=(0, 0), mode='constant'):
+        """Input frames (B, C, (num_out - 1) * stride + kernel_size) of all outputs ready in this call."""
+        buf, started = self.cache.get(key, (x[:, :, :0], False))
+        buf = torch.concat([buf, x], dim=2)
+        if started is False:
+            # reflect padding needs more frames than padding
+            if buf.size(2) <= padding[0] and self.finalize is False:
+                self.cache[key] = (buf, False)
+                return buf[:, :, :0]
+            buf = F.pad(buf, (padding[0], 0), mode=mode)
+        if self.finalize is True:
+            buf = F.pad(buf, (0, padding[1]), mode=mode)
+        num_out = max((buf.size(2) - kernel_size) // stride + 1, 0)
+        self.cache[key] = (buf[:, :, num_out * stride:], True)
+        return buf[:, :, :(num_out - 1) * stride + kernel_size] if num_out > 0 else buf[:, :, :0]
+
+    def conv(self, key, conv, x):
+        kernel_size = conv.dilation[0] * (conv.kernel_size[0] - 1) + 1
+        x = self.window(key, x, kernel_size, conv.stride[0], (conv.padding[0], conv.padding[0]))
+        if x.size(2) == 0:
+            return x.new_zeros(x.size(0), conv.out_channels, 0)
+        return F.conv1d(x, conv.weight, conv.bias, conv.stride, 0, conv.dilation, conv.groups)
+
+    def conv_transpose(self, key, conv, x):
+        stride, kernel_size, padding = conv.stride[0], conv.kernel_size[0], conv.padding[0]
+        # buf holds input frames from start, num_out output frames are returned in previous calls
+        buf, start, num_in, num_out = self.cache.get(key, (x[:, :, :0], 0, 0, 0))
+        buf, num_in = torch.concat([buf, x], dim=2), num_in + x.size(2)
+        if self.finalize is True:
+            end = (num_in - 1) * stride - 2 * padding + kernel_size + conv.output_padding[0]
+        else:
+            # output n depends on inputs up to (n + padding) // stride
+            end = num_in * stride - padding
+        end = max(end, num_out)
+        if end == num_out:
+            self.cache[key] = (buf, start, num_in, num_out)
+            return x.new_zeros(x.size(0), conv.out_channels, 0)
+        offset = start * stride - padding
+        y = F.conv_transpose1d(buf, conv.weight, conv.bias, stride)[:, :, num_out - offset: end - offset]
+        # first input of the next output
+        drop = max(-(-(end + padding - kernel_size + 1) // stride) - start, 0)
+        self.cache[key] = (buf[:, :, drop:], start + drop, num_in, end)
+        return y
+
+    def align(self, key, *xs):
+        xs = [x if c is None else torch.concat([c, x], dim=2) for x, c in zip(xs, self.cache.get(key, [None] * len(xs)))]
+        num_frames = min([x.size(2) for x in xs])
+        self.cache[key] = [x[:, :, num_frames:] for x in xs]
+        return [x[:, :, :num_frames] for x in xs]
+
+    def add(self, key, *xs):
+        xs = self.align(key, *xs)
+        for x in xs[1:]:
+            xs[0] = xs[0] + x
+        return xs[0]
+
+    def stft(self, key, x, stft):
+        """stft.stft(center=True) of x (B, T) in chunks."""
+        n_fft = stft.n_fft
+        x = self.window(key, x.unsqueeze(dim=1), n_fft, stft.hop_len, (n_fft // 2, n_fft // 2), 'reflect').squeeze(dim=1)
+        if x.size(1) == 0:
+            return x.new_zeros(x.size(0), n_fft // 2 + 1, 0), x.new_zeros(x.size(0), n_fft // 2 + 1, 0)
+        return stft.stft(x, center=False)
+
+    def istft(self, key, x, stft):
+        """stft.istft of conv_post output x in chunks, the overlap of the last frames and its window envelope are cached."""
+        n_fft, hop_len = stft.n_fft, stft.hop_len
+        # pos is the index of y[:, 0] in the n_fft // 2 padded signal
+        y_cache, envelope_cache, pos = self.cache.get(key, (None, None, 0))
+        num_frames = x.size(2)
+        if num_frames == 0:
+            if self.finalize is False or y_cache is None:
+                return x.new_zeros(x.size(0), 0)
+            y, envelope = y_cache, envelope_cache
+        else:
+            output_size = (1, (num_frames - 1) * hop_len + n_fft)
+            y = F.fold(stft.frames(x), output_size, (1, n_fft), stride=(1, hop_len)).flatten(1)
+            envelope = F.fold(stft.window.pow(2).view(1, -1, 1).repeat(1, 1, num_frames), output_size, (1, n_fft), stride=(1, hop_len)).flatten(1)
+            if y_cache is not None:
+                y[:, :y_cache.size(1)] += y_cache
+                envelope[:, :envelope_cache.size(1)] += envelope_cache
+        end = y.size(1) - n_fft // 2 if self.finalize is True else num_frames * hop_len
+        self.cache[key] = (y[:, end:], envelope[:, end:], pos + end)
+        start = max(n_fft // 2 - pos, 0)
+        return y[:, start:end] / envelope[:, start:end]
+
+
 class ResBlock(torch.nn.Module):
     """Residual block module in HiFiGAN/BigVGAN."""
     def __init__(
@@ -100,6 +257,15 @@ class ResBlock(torch.nn.Module):
             x = xt + x
         return x
 
+    def forward_stream(self, x: torch.Tensor, stream: HiFTStream, key: str) -> torch.Tensor:
+        for idx in range(len(self.convs1)):
+            xt = self.activations1[idx](x)
+            xt = stream.conv('{}.convs1.{}'.format(key, idx), self.convs1[idx], xt)
+            xt = self.activations2[idx](xt)
+            xt = stream.conv('{}.convs2.{}'.format(key, idx), self.convs2[idx], xt)
+            x = stream.add('{}.residual.{}'.format(key, idx), xt, x)
+        return x
+
     def remove_weight_norm(self):
         for idx in range(len(self.convs1)):
             remove_weight_norm(self.convs1[idx])
@@ -138,20 +304,25 @@ class SineGen(torch.nn.Module):
         return uv
 
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, stream=None):
         """
         :param f0: [B, 1, sample_len], Hz
+        :param stream: HiFTStream, carries the phase and the random initial phase across chunks
         :return: [B, 1, sample_len]
         """
 
-        F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1))).to(f0.device)
-        for i in range(self.harmonic_num + 1):
-            F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
+        # all harmonics in one broadcast, [B, harmonic_num + 1, sample_len]
+        F_mat = f0 * torch.arange(1, self.harmonic_num + 2, device=f0.device).view(1, -1, 1) / self.sampling_rate
 
-        theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
-        phase_vec[:, 0, :] = 0
+        phase, phase_vec = (None, None) if stream is None else stream.cache.get('l_sin_gen', (None, None))
+        cumsum = torch.cumsum(F_mat, dim=-1) if phase is None else torch.cumsum(F_mat, dim=-1) + phase
+        theta_mat = 2 * np.pi * (cumsum % 1)
+        if phase_vec is None:
+            u_dist = Uniform(low=-np.pi, high=np.pi)
+            phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+            phase_vec[:, 0, :] = 0
+        if stream is not None:
+            stream.cache['l_sin_gen'] = (cumsum[:, :, -1:] % 1 if cumsum.size(-1) != 0 else phase, phase_vec)
 
         # generate sine waveforms
         sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
@@ -204,7 +375,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, stream=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
@@ -213,7 +384,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2), stream)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
@@ -262,26 +433,23 @@ class SineGen2(torch.nn.Module):
         """ f0_values: (batchsize, length, dim)
             where dim indicates fundamental tone and overtones
         """
-        # convert to F0 in rad. The interger part n can be ignored
-        # because 2 * np.pi * n doesn't affect phase
-        rad_values = (f0_values / self.sampling_rate) % 1
-
-        # initial phase noise (no noise for fundamental component)
-        rand_ini = torch.rand(f0_values.shape[0], f0_values.shape[2], device=f0_values.device)
-        rand_ini[:, 0] = 0
-        rad_values[:, 0, :] = rad_values[:, 0, :] + rand_ini
-
         # instantanouse phase sine[t] = sin(2*pi \sum_i=1 ^{t} rad)
         if not self.flag_for_pulse:
-            rad_values = torch.nn.functional.interpolate(rad_values.transpose(1, 2),
-                                                         scale_factor=1 / self.upsample_scale,
-                                                         mode="linear").transpose(1, 2)
-
-            phase = torch.cumsum(rad_values, dim=1) * 2 * np.pi
-            phase = torch.nn.functional.interpolate(phase.transpose(1, 2) * self.upsample_scale,
-                                                    scale_factor=self.upsample_scale, mode="linear").transpose(1, 2)
-            sines = torch.sin(phase)
+            # f0_values is f0 of frames nearest upsampled by upsample_scale, linear downsampling takes the value of
+            # every frame, so only frames are accumulated and the phase is linearly upsampled in closed form
+            # NOTE no initial phase noise, it never survived the linear downsampling
+            x, _ = self._frame_phase((f0_values[:, ::self.upsample_scale] / self.sampling_rate) % 1)
+            sines = self._upsample_sine(F.pad(x, (1, 1)))
         else:
+            # convert to F0 in rad. The interger part n can be ignored
+            # because 2 * np.pi * n doesn't affect phase
+            rad_values = (f0_values / self.sampling_rate) % 1
+
+            # initial phase noise (no noise for fundamental component)
+            rand_ini = torch.rand(f0_values.shape[0], f0_values.shape[2], device=f0_values.device)
+            rand_ini[:, 0] = 0
+            rad_values[:, 0, :] = rad_values[:, 0, :] + rand_ini
+
             # If necessary, make sure that the first time step of every
             # voiced segments is sin(pi) or cos(0)
             # This is used for pulse-train generation
@@ -311,18 +479,59 @@ class SineGen2(torch.nn.Module):
             sines = torch.cos(i_phase * 2 * np.pi)
         return sines
 
-    def forward(self, f0):
+    def _frame_phase(self, rad_values, phase=0):
+        """ rad_values: (batchsize, frames, dim) rad of every frame
+            phase: phase in cycles before the first frame, carried in from the previous chunk
+            return: (batchsize, 2 * dim + 1, frames) phase in cycles of every frame, its step from the previous
+                frame and ones marking valid frames, and the wrapped phase after the last frame to carry out
+        """
+        step = rad_values * self.upsample_scale
+        frame_phase = torch.cumsum(step, dim=1) + phase
+        if frame_phase.size(1) != 0:
+            phase = frame_phase[:, -1:] % 1
+        return torch.concat([frame_phase, step, torch.ones_like(step[:, :, :1])], dim=2).transpose(1, 2), phase
+
+    def _upsample_sine(self, x):
+        """ x: output of _frame_phase with one more frame on both sides, zeros beyond the utterance
+            return: (batchsize, (frames - 2) * upsample_scale, dim) sines, samples of the first/last half of a frame
+                ramp from/to the phase of the previous/next frame, the phase is clamped at both ends
+        """
+        dim = (x.size(1) - 1) // 2
+        phase, prev_step, next_step = x[:, :dim, 1:-1, None], x[:, dim:-1, 1:-1, None] * x[:, -1:, :-2, None], x[:, dim:-1, 2:, None]
+        offset = (torch.arange(self.upsample_scale, device=x.device) + 0.5) / self.upsample_scale - 0.5
+        phase = phase + offset.clamp(max=0) * prev_step + offset.clamp(min=0) * next_step
+        return torch.sin(2 * np.pi * phase.flatten(2).transpose(1, 2))
+
+    def _f02sine_stream(self, f0_values, stream):
+        """ _f02sine without flag_for_pulse, f0_values hold whole frames of upsample_scale samples.
+            The phase is carried in stream, samples of a frame interpolate the phase of the next frame,
+            so the output is one frame behind f0_values.
+        """
+        x, stream.cache['l_sin_gen.phase'] = self._frame_phase((f0_values[:, ::self.upsample_scale] / self.sampling_rate) % 1,
+                                                               stream.cache.get('l_sin_gen.phase', 0))
+        x = stream.window('l_sin_gen.window', x, 3, 1, (1, 1))
+        if x.size(2) == 0:
+            return f0_values.new_zeros(f0_values.size(0), 0, f0_values.size(2))
+        return self._upsample_sine(x)
+
+    def forward(self, f0, stream=None):
         """ sine_tensor, uv = forward(f0)
         input F0: tensor(batchsize=1, length, dim=1)
                   f0 for unvoiced steps should be 0
         output sine_tensor: tensor(batchsize=1, length, dim)
         output uv: tensor(batchsize=1, length, 1)
+        NOTE with stream, the phase is carried across chunks and the output is one frame behind f0
         """
         # fundamental component
-        fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        fn = f0 * torch.arange(1, self.harmonic_num + 2, device=f0.device)
 
         # generate sine waveforms
-        sine_waves = self._f02sine(fn) * self.sine_amp
+        if stream is None:
+            sine_waves = self._f02sine(fn) * self.sine_amp
+        else:
+            assert self.flag_for_pulse is False
+            sine_waves = self._f02sine_stream(fn, stream) * self.sine_amp
+            f0, sine_waves = [i.transpose(1, 2) for i in stream.align('l_sin_gen.f0', f0.transpose(1, 2), sine_waves.transpose(1, 2))]
 
         # generate uv signal
         uv = self._f02uv(f0)
@@ -372,16 +581,17 @@ class SourceModuleHnNSF2(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, stream=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
+        NOTE with stream, the output is one frame behind x
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x)
+            sine_wavs, uv, _ = self.l_sin_gen(x, stream)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
 
         # source for noise branch, in the same shape as uv
@@ -413,6 +623,7 @@ class HiFTGenerator(nn.Module):
             lrelu_slope: float = 0.1,
             audio_limit: float = 0.99,
             f0_predictor: torch.nn.Module = None,
+            conv_istft: bool = False,
     ):
         super(HiFTGenerator, self).__init__()
 
@@ -484,7 +695,7 @@ class HiFTGenerator(nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
-        self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        self.stft = STFT(istft_params["n_fft"], istft_params["hop_len"], conv_istft=conv_istft)
         self.f0_predictor = f0_predictor
 
     def remove_weight_norm(self):
@@ -501,24 +712,8 @@ class HiFTGenerator(nn.Module):
         for l in self.source_resblocks:
             l.remove_weight_norm()
 
-    def _stft(self, x):
-        spec = torch.stft(
-            x,
-            self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.to(x.device),
-            return_complex=True)
-        spec = torch.view_as_real(spec)  # [B, F, TT, 2]
-        return spec[..., 0], spec[..., 1]
-
-    def _istft(self, magnitude, phase):
-        magnitude = torch.clip(magnitude, max=1e2)
-        real = magnitude * torch.cos(phase)
-        img = magnitude * torch.sin(phase)
-        inverse_transform = torch.istft(torch.complex(real, img), self.istft_params["n_fft"], self.istft_params["hop_len"],
-                                        self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
-        return inverse_transform
-
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
-        s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
+        s_stft_real, s_stft_imag = self.stft.stft(s.squeeze(1))
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
         x = self.conv_pre(x)
@@ -544,10 +739,35 @@ class HiFTGenerator(nn.Module):
 
         x = F.leaky_relu(x)
         x = self.conv_post(x)
-        magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
-        phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
+        x = self.stft.istft(x)
+        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
+        return x
+
+    def decode_stream(self, x: torch.Tensor, s: torch.Tensor, stream: HiFTStream) -> torch.Tensor:
+        """decode of a chunk, x and s do not need to be aligned, the caches are kept in stream."""
+        s_stft_real, s_stft_imag = stream.stft('stft', s.squeeze(1), self.stft)
+        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
-        x = self._istft(magnitude, phase)
+        x = stream.conv('conv_pre', self.conv_pre, x)
+        for i in range(self.num_upsamples):
+            x = F.leaky_relu(x, self.lrelu_slope)
+            x = stream.conv_transpose('ups.{}'.format(i), self.ups[i], x)
+
+            if i == self.num_upsamples - 1:
+                x = stream.window('reflection_pad', x, 1, 1, self.reflection_pad.padding, 'reflect')
+
+            # fusion
+            si = stream.conv('source_downs.{}'.format(i), self.source_downs[i], s_stft)
+            si = self.source_resblocks[i].forward_stream(si, stream, 'source_resblocks.{}'.format(i))
+            x = stream.add('fusion.{}'.format(i), x, si)
+
+            xs = [self.resblocks[i * self.num_kernels + j].forward_stream(x, stream, 'resblocks.{}'.format(i * self.num_kernels + j))
+                  for j in range(self.num_kernels)]
+            x = stream.add('resblocks.{}'.format(i), *xs) / self.num_kernels
+
+        x = F.leaky_relu(x)
+        x = stream.conv('conv_post', self.conv_post, x)
+        x = stream.istft('istft', x, self.stft)
         x = torch.clamp(x, -self.audio_limit, self.audio_limit)
         return x
 
@@ -580,3 +800,53 @@ class HiFTGenerator(nn.Module):
             s[:, :, :cache_source.shape[2]] = cache_source
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
+
+    @torch.inference_mode()
+    def inference_stream(self, speech_feat: torch.Tensor, hift_state: Optional[HiFTStream] = None,
+                         finalize: bool = False) -> Tuple[torch.Tensor, HiFTStream]:
+        """Streaming inference, speech_feat holds the new mel frames only.
+
+        hift_state is returned by the previous chunk, None for the first chunk. Convolution contexts, the source
+        phase and the stft/istft overlaps are cached in it, so no frame is computed twice and no cross fade is needed.
+        Samples whose receptive field reaches beyond speech_feat are returned by later chunks, the concatenated
+        output of all chunks equals inference on the whole mel, except for the random noise of the source.
+        """
+        stream = HiFTStream() if hift_state is None else hift_state
+        stream.finalize = finalize
+        # mel->f0
+        f0 = self.f0_predictor.forward_stream(speech_feat, stream)
+        # f0->source, nearest upsampling as f0_upsamp
+        s = f0.unsqueeze(dim=2).repeat_interleave(int(self.f0_upsamp.scale_factor), dim=1)  # bs,t,n
+        s, _, _ = self.m_source(s, stream)
+        s = s.transpose(1, 2)
+        generated_speech = self.decode_stream(x=speech_feat, s=s, stream=stream)
+        return generated_speech, stream
+
+    @torch.inference_mode()
+    def inference_batch(self, speech_feat: List[torch.Tensor], cache_source: List[torch.Tensor]) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Run f0_predictor, m_source and decode once for mels of different lengths.
+
+        Args:
+            speech_feat: list of mel (1, 80, T_i)
+            cache_source: list of source cache (1, 1, L_i), L_i can be 0
+        Returns:
+            list of speech (1, T_i * upsample_scale) and list of source (1, 1, T_i * upsample_scale)
+        NOTE the last few frames of a padded item may differ slightly from inference,
+            as convolutions see the padded frames instead of zero padding
+        """
+        mel_len = [i.shape[2] for i in speech_feat]
+        speech_feat = pad_sequence([i.squeeze(dim=0).transpose(0, 1) for i in speech_feat], batch_first=True, padding_value=0).transpose(1, 2)
+        # mel->f0
+        f0 = self.f0_predictor(speech_feat)
+        # f0->source
+        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+        s, _, _ = self.m_source(s)
+        s = s.transpose(1, 2)
+        # use cache_source to avoid glitch
+        for i, j in enumerate(cache_source):
+            if j.shape[2] != 0:
+                s[i, :, :j.shape[2]] = j
+        generated_speech = self.decode(x=speech_feat, s=s)
+        upsample_scale = s.shape[2] // speech_feat.shape[2]
+        return [generated_speech[i:i + 1, :mel_len[i] * upsample_scale] for i in range(len(mel_len))], \
+            [s[i:i + 1, :, :mel_len[i] * upsample_scale] for i in range(len(mel_len))]
@@ -16,15 +16,16 @@ import queue
 import random
 import time
 import threading
-from typing import Dict, Optional, Callable, List, Generator
+from typing import Dict, Optional, Callable, List, Generator, Union
 import torch
 from torch import nn
 import torch.nn.functional as F
 from transformers import Qwen2ForCausalLM
+from transformers.cache_utils import Cache
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
-from cosyvoice.utils.common import th_accuracy
+from cosyvoice.utils.common import th_accuracy, ras_sampling_prob
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.mask import make_pad_mask
 
@@ -43,6 +44,8 @@ class TransformerLM(torch.nn.Module):
             length_normalized_loss: bool = True,
             lsm_weight: float = 0.0,
             spk_embed_dim: int = 192,
+            prefill_chunk_size: int = -1,
+            loop_guard: Optional[Callable] = None,
     ):
         super().__init__()
         self.llm_input_size = llm_input_size
@@ -75,6 +78,12 @@ class TransformerLM(torch.nn.Module):
         # 4. sampling method
         self.sampling = sampling
 
+        # 5. inference related, <= 0 means prefill lm_input in one forward
+        self.prefill_chunk_size = prefill_chunk_size
+        # stop decoding when generated tokens loop instead of waiting for max_len, None (default) disables it
+        self.loop_guard = loop_guard
+        self.loop_stats = {'repetition': 0}
+
     def encode(
             self,
             text: torch.Tensor,
@@ -147,22 +156,33 @@ class TransformerLM(torch.nn.Module):
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
-            decoded_tokens: List,
+            decoded_tokens: Union[List, torch.Tensor],
             sampling: int,
-            ignore_eos: bool = True,
+            ignore_eos: Union[bool, torch.Tensor] = True,
     ):
-        num_trials, max_trials = 0, 100
-        while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
-                break
-            num_trials += 1
-            if num_trials > max_trials:
-                raise RuntimeError('sampling reaches max_trials {} and still get eos when ignore_eos is True, check your input!'.format(max_trials))
-        return top_ids
+        """Sample (1,) ids from (V,) scores, or (B, 1) ids from (B, V) scores with (B, T) decoded_tokens history.
 
-    @torch.inference_mode()
-    def inference(
+        ignore_eos is a bool or a (B,) bool tensor, eos is masked out before sampling instead of rejected after it.
+        """
+        ignore_mask = None
+        if torch.is_tensor(ignore_eos) or ignore_eos is True:
+            ignore_mask = torch.arange(weighted_scores.size(-1), device=weighted_scores.device) == self.speech_token_size
+            if torch.is_tensor(ignore_eos):
+                ignore_mask = ignore_mask & ignore_eos.to(weighted_scores.device).view(-1, 1)
+        return self.sampling(weighted_scores, decoded_tokens, sampling, ignore_mask=ignore_mask)
+
+    def is_looping(self, out_tokens, uuid=''):
+        """Return True if out_tokens end with a degenerate loop detected by loop_guard, decoding should stop as if eos."""
+        if self.loop_guard is None:
+            return False
+        reason = self.loop_guard(out_tokens)
+        if reason is None:
+            return False
+        self.loop_stats[reason] += 1
+        logging.warning('stop decoding {} after {} speech tokens, {} loop detected'.format(uuid, len(out_tokens), reason))
+        return True
+
+    def prepare_lm_input(
             self,
             text: torch.Tensor,
             text_len: torch.Tensor,
@@ -171,14 +191,10 @@ class TransformerLM(torch.nn.Module):
             prompt_speech_token: torch.Tensor,
             prompt_speech_token_len: torch.Tensor,
             embedding: torch.Tensor,
-            sampling: int = 25,
-            max_token_text_ratio: float = 20,
-            min_token_text_ratio: float = 2,
-            uuid: str = '',
-    ) -> Generator[torch.Tensor, None, None]:
+    ) -> torch.Tensor:
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
-        text_len += prompt_text_len
+        text_len = text_len + prompt_text_len
         text = self.text_embedding(text)
 
         # 1. encode text
@@ -200,20 +216,64 @@ class TransformerLM(torch.nn.Module):
         else:
             prompt_speech_token_emb = torch.zeros(1, 0, self.llm_input_size, dtype=text.dtype).to(device)
         lm_input = torch.concat([sos_eos_emb, embedding, text, task_id_emb, prompt_speech_token_emb], dim=1)
+        return lm_input
+
+    def forward_draft(self, xs, att_cache):
+        """Forward xs (1, T, D) after att_cache, used when this model is the draft of Qwen2LM speculative decoding."""
+        cache_len = att_cache.size(2)
+        att_mask = torch.tril(torch.ones((1, xs.size(1), cache_len + xs.size(1)), device=xs.device), diagonal=cache_len).to(torch.bool)
+        y_pred, att_cache, _ = self.llm.forward_chunk(xs, offset=cache_len, required_cache_size=-1,
+                                                      att_cache=att_cache, cnn_cache=torch.zeros((0, 0, 0, 0), device=xs.device),
+                                                      att_mask=att_mask)
+        return self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1), att_cache
+
+    def forward_step(self, xs, offset, att_cache, cnn_cache):
+        """Forward xs (1, T, D) after offset frames of att_cache, which is updated in place unless llm is a jit module."""
+        att_mask = torch.tril(torch.ones((1, xs.size(1), offset + xs.size(1)), device=xs.device), diagonal=offset).to(torch.bool)
+        if hasattr(self.llm, 'forward_chunk_in_place'):
+            y_pred, att_cache = self.llm.forward_chunk_in_place(xs, offset, att_cache, att_mask)
+            return y_pred, att_cache, cnn_cache
+        return self.llm.forward_chunk(xs, offset=offset, required_cache_size=-1, att_cache=att_cache, cnn_cache=cnn_cache, att_mask=att_mask)
+
+    def prefill(self, lm_input, offset, att_cache, cnn_cache):
+        """Forward lm_input chunk by chunk until at most prefill_chunk_size frames are left, return them, offset and the caches."""
+        while 0 < self.prefill_chunk_size < lm_input.size(1):
+            xs, lm_input = lm_input[:, :self.prefill_chunk_size], lm_input[:, self.prefill_chunk_size:]
+            _, att_cache, cnn_cache = self.forward_step(xs, offset, att_cache, cnn_cache)
+            offset += xs.size(1)
+        return lm_input, offset, att_cache, cnn_cache
+
+    @torch.inference_mode()
+    def inference(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+            sampling: int = 25,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+            uuid: str = '',
+    ) -> Generator[torch.Tensor, None, None]:
+        lm_input = self.prepare_lm_input(text, text_len, prompt_text, prompt_text_len, prompt_speech_token, prompt_speech_token_len, embedding)
 
         # 4. cal min/max_length
-        min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
-        max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
+        min_len = int(text_len * min_token_text_ratio)
+        max_len = int(text_len * max_token_text_ratio)
 
         # 5. step by step decode
         out_tokens = []
-        offset = 0
         att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        if hasattr(self.llm, 'forward_chunk_in_place'):
+            # kv of lm_input and at most max_len speech tokens, written in place step by step
+            dtype = torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else lm_input.dtype
+            att_cache = self.llm.init_att_cache(lm_input.size(1) + max_len, lm_input.device, dtype)
+        lm_input, offset, att_cache, cnn_cache = self.prefill(lm_input, 0, att_cache, cnn_cache)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            y_pred, att_cache, cnn_cache = self.forward_step(lm_input, offset, att_cache, cnn_cache)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
             # force continue decode first token
             if i == 0:
@@ -224,10 +284,92 @@ class TransformerLM(torch.nn.Module):
             # in stream mode, yield token one by one
             yield top_ids
             out_tokens.append(top_ids)
+            if self.is_looping(out_tokens, uuid):
+                break
             offset += lm_input.size(1)
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
 
+class StaticKVCache(Cache):
+    """Pre-allocated kv cache for Qwen2Encoder.forward_one_step.
+
+    K/V of every layer are written in place into (1, num_heads, capacity, head_dim) buffers instead of
+    being concatenated to the cache of previous step, so one decode step does not copy the whole cache.
+    Buffers are allocated on first update with the dtype/device of key states, and doubled if capacity
+    is exceeded, which should not happen when capacity is sized from lm_input length + max_len.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.key_cache: List[torch.Tensor] = []
+        self.value_cache: List[torch.Tensor] = []
+        self.cache_lens: List[int] = []
+        self.causal_masks = None
+
+    def __len__(self):
+        return len(self.key_cache)
+
+    def __getitem__(self, layer_idx: int):
+        cache_len = self.cache_lens[layer_idx]
+        return self.key_cache[layer_idx][:, :, :cache_len], self.value_cache[layer_idx][:, :, :cache_len]
+
+    @classmethod
+    def from_prefix(cls, prefix_cache, capacity: int):
+        """New cache of capacity tokens after the legacy kv cache tuple prefix_cache, which is copied."""
+        cache = cls(capacity)
+        if prefix_cache is not None:
+            cache.capacity += prefix_cache[0][0].size(2)
+            for i, (k, v) in enumerate(prefix_cache):
+                cache.update(k, v, i)
+        return cache
+
+    def crop(self, length: int):
+        """Drop kv of positions after length, e.g. rejected draft tokens, buffers are kept."""
+        self.cache_lens = [min(i, length) for i in self.cache_lens]
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self.cache_lens[layer_idx] if layer_idx < len(self.cache_lens) else 0
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
+    def to_legacy_cache(self):
+        return tuple(self[i] for i in range(len(self)))
+
+    def grow(self, size: int):
+        capacity = max(self.capacity * 2, size)
+        logging.warning('kv cache capacity {} exceeded, grow to {}'.format(self.capacity, capacity))
+        for i in range(len(self.key_cache)):
+            k, v = self.key_cache[i], self.value_cache[i]
+            self.key_cache[i] = torch.zeros(k.size(0), k.size(1), capacity, k.size(3), dtype=k.dtype, device=k.device)
+            self.value_cache[i] = torch.zeros(v.size(0), v.size(1), capacity, v.size(3), dtype=v.dtype, device=v.device)
+            self.key_cache[i][:, :, :self.cache_lens[i]] = k[:, :, :self.cache_lens[i]]
+            self.value_cache[i][:, :, :self.cache_lens[i]] = v[:, :, :self.cache_lens[i]]
+        self.capacity = capacity
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int, cache_kwargs: Optional[Dict] = None):
+        if layer_idx == len(self.key_cache):
+            b, h, _, d = key_states.shape
+            self.key_cache.append(torch.zeros(b, h, self.capacity, d, dtype=key_states.dtype, device=key_states.device))
+            self.value_cache.append(torch.zeros(b, h, self.capacity, d, dtype=value_states.dtype, device=value_states.device))
+            self.cache_lens.append(0)
+        start, end = self.cache_lens[layer_idx], self.cache_lens[layer_idx] + key_states.size(2)
+        if end > self.capacity:
+            self.grow(end)
+        self.key_cache[layer_idx][:, :, start:end] = key_states
+        self.value_cache[layer_idx][:, :, start:end] = value_states
+        self.cache_lens[layer_idx] = end
+        return self[layer_idx]
+
+    def masks(self, xs: torch.Tensor) -> torch.Tensor:
+        """Causal masks (1, T, cache_len + T) for the next forward of xs (1, T, D), sliced from a cached tril."""
+        start, end = self.get_seq_length(), self.get_seq_length() + xs.size(1)
+        if self.causal_masks is None or self.causal_masks.device != xs.device or self.causal_masks.size(1) < end:
+            size = max(self.capacity, end)
+            self.causal_masks = torch.tril(torch.ones((1, size, size), device=xs.device)).to(torch.bool)
+        return self.causal_masks[:, start:end, :end]
+
+
 class Qwen2Encoder(torch.nn.Module):
     def __init__(self, pretrain_path):
         super().__init__()
@@ -245,6 +387,7 @@ class Qwen2Encoder(torch.nn.Module):
         return outs.hidden_states[-1], masks.unsqueeze(1)
 
     def forward_one_step(self, xs, masks, cache=None):
+        # cache is None/legacy tuple, which is concatenated by transformers, or a StaticKVCache written in place
         input_masks = masks[:, -1, :]
         outs = self.model(
             inputs_embeds=xs,
@@ -258,6 +401,21 @@ class Qwen2Encoder(torch.nn.Module):
         new_cache = outs.past_key_values
         return xs, new_cache
 
+    def forward_batch_step(self, xs, attention_mask, position_ids, cache):
+        # xs (B, 1, D), cache is left padded to the same length, attention_mask (B, cache_len + 1) marks the valid part
+        outs = self.model(
+            inputs_embeds=xs,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            output_hidden_states=True,
+            return_dict=True,
+            use_cache=True,
+            past_key_values=cache,
+        )
+        xs = outs.hidden_states[-1]
+        new_cache = outs.past_key_values
+        return xs, new_cache
+
 
 class Qwen2LM(TransformerLM):
     def __init__(
@@ -270,6 +428,8 @@ class Qwen2LM(TransformerLM):
             length_normalized_loss: bool = True,
             lsm_weight: float = 0.0,
             mix_ratio: List[int] = [5, 15],
+            prefill_chunk_size: int = -1,
+            loop_guard: Optional[Callable] = None,
     ):
         torch.nn.Module.__init__(self)
         self.llm_input_size = llm_input_size
@@ -296,6 +456,11 @@ class Qwen2LM(TransformerLM):
         # 4. sampling method
         self.sampling = sampling
         self.mix_ratio = mix_ratio
+        # <= 0 means prefill lm_input in one forward
+        self.prefill_chunk_size = prefill_chunk_size
+        # stop decoding when generated tokens loop instead of waiting for max_len, None (default) disables it
+        self.loop_guard = loop_guard
+        self.loop_stats = {'repetition': 0}
 
         # 5. vllm related
         self.stop_token_ids = [speech_token_size + i for i in range(3)]
@@ -439,6 +604,9 @@ class Qwen2LM(TransformerLM):
             uuid: str = '',
     ) -> Generator[torch.Tensor, None, None]:
         device = text.device
+        draft_lm_input = None
+        if hasattr(self, 'draft') and self.num_draft_tokens > 0:
+            draft_lm_input = self.draft.prepare_lm_input(text, text_len, prompt_text, prompt_text_len, prompt_speech_token, prompt_speech_token_len, embedding)
         text = torch.concat([prompt_text, text], dim=1)
         text_len += prompt_text_len
         text = self.llm.model.model.embed_tokens(text)
@@ -456,13 +624,45 @@ class Qwen2LM(TransformerLM):
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
-        # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+        # 5. reuse kv cache of [sos, prompt_text] prefix
+        cache = None
+        if hasattr(self, 'prefix_cache') and prompt_text_len != 0:
+            prefix_len = 1 + int(prompt_text_len)
+            cache = self.get_prefix_cache(prompt_text, lm_input[:, :prefix_len])
+            lm_input = lm_input[:, prefix_len:]
+
+        # 6. step by step decode
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid, cache=cache, draft_lm_input=draft_lm_input):
             yield token
 
+    def prefill(self, lm_input, cache):
+        """Forward lm_input chunk by chunk into StaticKVCache cache until at most prefill_chunk_size frames are left, return them."""
+        while 0 < self.prefill_chunk_size < lm_input.size(1):
+            xs, lm_input = lm_input[:, :self.prefill_chunk_size], lm_input[:, self.prefill_chunk_size:]
+            _, cache = self.llm.forward_one_step(xs, masks=cache.masks(xs), cache=cache)
+        return lm_input
+
     @torch.inference_mode()
-    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
+    def get_prefix_cache(self, prompt_text, prefix_input):
+        """Legacy kv cache tuple of prefix_input, shared by requests with the same prompt_text.
+
+        NOTE only [sos, prompt_text] is a common prefix, prompt_speech_token comes after text in lm_input.
+        The returned tensors must not be modified in place, StaticKVCache and transformers both copy them.
+        """
+        key = tuple(prompt_text.view(-1).tolist())
+        cache = self.prefix_cache.get(key)
+        if cache is None:
+            _, cache = self.llm.forward_one_step(prefix_input,
+                                                 masks=torch.tril(torch.ones((1, prefix_input.size(1), prefix_input.size(1)), device=prefix_input.device)).to(torch.bool),
+                                                 cache=None)
+            cache = tuple((k, v) for k, v in cache)
+            self.prefix_cache.put(key, cache)
+        return cache
+
+    @torch.inference_mode()
+    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid, cache=None, draft_lm_input=None):
         if hasattr(self, 'vllm'):
+            assert cache is None, 'vllm do not support prefix kv cache!'
             from vllm import SamplingParams, RequestOutput
             sampling_params = SamplingParams(top_k=sampling,
                                              stop_token_ids=self.stop_token_ids,
@@ -488,15 +688,33 @@ class Qwen2LM(TransformerLM):
                     out_tokens.append(top_ids)
                     if len(out_tokens) == max_len:
                         break
+                    if self.is_looping(out_tokens, uuid):
+                        with self.lock:
+                            self.vllm.abort_request(uuid)
+                        break
                 time.sleep(0.001)
             with self.lock:
                 self.vllm_output_queue.pop(uuid)
+        elif hasattr(self, 'scheduler'):
+            output_queue = self.scheduler.add_request(uuid, lm_input, sampling, min_len, max_len, cache=cache)
+            while True:
+                top_ids = output_queue.get()
+                if top_ids is None:
+                    break
+                if isinstance(top_ids, Exception):
+                    raise top_ids
+                # in stream mode, yield token one by one
+                yield top_ids
+        elif draft_lm_input is not None:
+            for top_ids in self.inference_speculative(lm_input, draft_lm_input, min_len, max_len, cache=cache, uuid=uuid):
+                yield top_ids
         else:
             out_tokens = []
-            cache = None
+            cache = StaticKVCache.from_prefix(cache, lm_input.size(1) + max_len)
+            lm_input = self.prefill(lm_input, cache)
             for i in range(max_len):
                 y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                          masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
+                                                          masks=cache.masks(lm_input),
                                                           cache=cache)
                 logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
                 top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
@@ -507,8 +725,94 @@ class Qwen2LM(TransformerLM):
                 # in stream mode, yield token one by one
                 yield top_ids
                 out_tokens.append(top_ids)
+                if self.is_looping(out_tokens, uuid):
+                    break
                 lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
+    @torch.inference_mode()
+    def inference_speculative(self, lm_input, draft_lm_input, min_len, max_len, cache=None, uuid=''):
+        """Speculative decoding, self.draft proposes num_draft_tokens tokens and one forward of self.llm verifies them.
+
+        A draft token x is accepted with prob min(1, p(x) / q(x)), otherwise a token is sampled from norm(max(p - q, 0)),
+        where p/q are the distributions ras_sampling draws from given target/draft logits and the same history.
+        Fill/task tokens are masked out of p and q, so output tokens follow the ras distribution conditioned on speech
+        tokens and eos. This differs from inference_wrapper, which skips a sampled fill/task token with continue,
+        spending one step of max_len and forwarding the same lm_input again.
+        """
+        sampling_kwargs = getattr(self.sampling, 'keywords', {})
+        win_size = sampling_kwargs.get('win_size', 10)
+        vocab_size = self.llm_decoder.out_features
+        special_mask = torch.arange(vocab_size, device=lm_input.device) > self.speech_token_size
+        eos_mask = torch.arange(vocab_size, device=lm_input.device) == self.speech_token_size
+
+        def ras_prob(logp, tokens, start):
+            # logp (n, V) is logp of position start ... start + n - 1, tokens[:start + j] is the history of row j
+            history = pad_sequence([torch.tensor(tokens[max(0, start + j - win_size): start + j], dtype=torch.long) for j in range(logp.size(0))],
+                                   batch_first=True, padding_value=-1).to(logp.device)
+            ignore_eos = (torch.arange(logp.size(0), device=logp.device) + start < min_len).view(-1, 1)
+            return ras_sampling_prob(logp, history, ignore_mask=special_mask | (eos_mask & ignore_eos), **sampling_kwargs)
+
+        out_tokens = []
+        cache = StaticKVCache.from_prefix(cache, lm_input.size(1) + max_len + self.num_draft_tokens)
+        draft_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        # inputs which are not in target/draft kv cache yet
+        pending, draft_pending = self.prefill(lm_input, cache), draft_lm_input
+        while len(out_tokens) < max_len:
+            # 1. draft tokens, at most max_len - 1 in total so that the token sampled by target does not exceed max_len
+            num_draft, draft_tokens, draft_probs = min(self.num_draft_tokens, max_len - len(out_tokens) - 1), [], []
+            draft_cache_len, draft_pending_len = draft_cache.size(2), draft_pending.size(1)
+            for j in range(num_draft):
+                draft_logp, draft_cache = self.draft.forward_draft(draft_pending, draft_cache)
+                draft_logp = F.pad(draft_logp.float(), (0, vocab_size - draft_logp.size(1)), value=-float('inf'))
+                q = ras_prob(draft_logp, out_tokens + draft_tokens, len(out_tokens) + len(draft_tokens))[0]
+                draft_tokens.append(q.multinomial(1).item())
+                draft_probs.append(q)
+                if draft_tokens[-1] == self.speech_token_size:
+                    break
+                draft_pending = self.draft.speech_embedding.weight[draft_tokens[-1]].reshape(1, 1, -1)
+            self.draft_stats['proposed'] += len(draft_tokens)
+            self.draft_stats['forward'] += 1
+
+            # 2. verify all draft tokens in one forward, logp[j] is target logp of draft_tokens[j]
+            cache_len = cache.get_seq_length()
+            xs = torch.concat([pending, self.speech_embedding.weight[draft_tokens].reshape(1, len(draft_tokens), self.llm_input_size)], dim=1)
+            y_pred, cache = self.llm.forward_one_step(xs, masks=cache.masks(xs), cache=cache)
+            logp = self.llm_decoder(y_pred[0, pending.size(1) - 1:]).log_softmax(dim=-1).float()
+            p = ras_prob(logp, out_tokens + draft_tokens, len(out_tokens))
+            num_accept, top_ids = 0, None
+            for j, x in enumerate(draft_tokens):
+                if torch.rand(1).item() * draft_probs[j][x].item() < p[j, x].item():
+                    num_accept += 1
+                    continue
+                residual = (p[j] - draft_probs[j]).clamp(min=0)
+                top_ids = (residual if residual.sum() > 0 else p[j]).multinomial(1).item()
+                break
+            if top_ids is None:
+                # all accepted, sample one more token from target
+                top_ids = p[len(draft_tokens)].multinomial(1).item() if len(draft_tokens) == 0 or draft_tokens[-1] != self.speech_token_size else None
+            self.draft_stats['accepted'] += num_accept
+            accepted = draft_tokens[:num_accept] + ([top_ids] if top_ids is not None else [])
+
+            # 3. output, stop at eos
+            for token in accepted:
+                if token == self.speech_token_size:
+                    return
+                # in stream mode, yield token one by one
+                yield token
+                out_tokens.append(token)
+                if self.is_looping(out_tokens, uuid):
+                    return
+
+            # 4. roll back kv cache of rejected tokens
+            cache.crop(cache_len + pending.size(1) + num_accept)
+            pending = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+            num_fed = min(num_accept, len(draft_tokens) - 1) if len(draft_tokens) != 0 else 0
+            if len(draft_tokens) != 0:
+                draft_cache = draft_cache[:, :, :draft_cache_len + draft_pending_len + num_fed]
+                draft_pending = self.draft.speech_embedding.weight[accepted[num_fed:]].reshape(1, len(accepted) - num_fed, self.draft.llm_input_size)
+            else:
+                draft_pending = torch.concat([draft_pending, self.draft.speech_embedding.weight[accepted].reshape(1, len(accepted), self.draft.llm_input_size)], dim=1)
+
     @torch.inference_mode()
     def inference_bistream(
             self,
@@ -521,6 +825,7 @@ class Qwen2LM(TransformerLM):
             sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
+            uuid: str = '',
     ) -> Generator[torch.Tensor, None, None]:
 
         device = prompt_text.device
@@ -531,10 +836,23 @@ class Qwen2LM(TransformerLM):
             prompt_speech_token_emb = self.speech_embedding(prompt_speech_token)
         else:
             prompt_speech_token_emb = torch.zeros(1, 0, self.llm_input_size, dtype=prompt_text.dtype).to(device)
+        if hasattr(self, 'scheduler'):
+            # decode together with other sessions, same interleaving as below
+            output_queue = self.scheduler.add_bistream_request(uuid, text, prompt_text, prompt_speech_token_emb, sampling)
+            while True:
+                top_ids = output_queue.get()
+                if top_ids is None:
+                    break
+                if isinstance(top_ids, Exception):
+                    raise top_ids
+                # in stream mode, yield token one by one
+                yield top_ids
+            return
         lm_input = torch.concat([sos_eos_emb], dim=1)
 
         # 2. iterate text
-        out_tokens = []
+        # NOTE loop guard runs on speech tokens only, fill tokens in out_tokens would break up repeated patterns
+        out_tokens, speech_tokens = [], []
         cache = None
         # NOTE init prompt_text as text_cache as it is basically impossible prompt_speech_token/prompt_text < 15/5
         text_cache = self.llm.model.model.embed_tokens(prompt_text)
@@ -587,6 +905,9 @@ class Qwen2LM(TransformerLM):
                         else:
                             raise ValueError('should not get token {}'.format(top_ids))
                     yield top_ids
+                    speech_tokens.append(top_ids)
+                    if self.is_looping(speech_tokens, uuid):
+                        return
                     lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
         # 3. final decode
@@ -607,4 +928,7 @@ class Qwen2LM(TransformerLM):
                     raise ValueError('should not get token {}'.format(top_ids))
             # in stream mode, yield token one by one
             yield top_ids
+            speech_tokens.append(top_ids)
+            if self.is_looping(speech_tokens, uuid):
+                break
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
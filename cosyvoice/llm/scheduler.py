@@ -0,0 +1,498 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+from collections import deque
+import torch
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+from cosyvoice.utils.file_utils import logging
+
+
+class LLMSession:
+    """Decoding state of one tts request, keyed by the same uuid as CosyVoice2Model session dicts."""
+
+    def __init__(self, uuid, lm_input, sampling, min_len, max_len, cache=None):
+        self.uuid = uuid
+        self.lm_input = lm_input
+        self.sampling = sampling
+        self.min_len = min_len
+        self.max_len = max_len
+        # NOTE cache may be a shared prefix kv cache, it is never modified in place
+        self.cache = cache
+        self.prefix_cache = cache
+        # inputs forwarded into the paged kv cache, moved to recompute on preemption and prepended to lm_input once ready again
+        self.forwarded = []
+        self.recompute = None
+        self.out_tokens = []
+        self.num_steps = 0
+        self.error = None
+        # speech token ids are put here one by one, None means end of decoding
+        self.output_queue = queue.Queue()
+
+    def cache_len(self):
+        return 0 if self.cache is None else self.cache[0][0].size(2)
+
+    def prepare(self):
+        """Return True if lm_input is ready to forward, called by the scheduler with its cond held."""
+        self.restore()
+        return True
+
+    def restore(self):
+        if self.recompute is not None:
+            self.lm_input = torch.concat([self.recompute, self.lm_input], dim=1)
+            self.recompute = None
+
+    def num_pending_frames(self):
+        return self.lm_input.size(1) + (0 if self.recompute is None else self.recompute.size(1))
+
+    def ignore_eos(self):
+        return self.num_steps < self.min_len
+
+    def update(self, llm, top_ids):
+        """Consume top_ids sampled after forwarding lm_input, return True if decoding is finished."""
+        self.num_steps += 1
+        if top_ids == llm.speech_token_size:
+            return True
+        # NOTE keep lm_input unchanged for fill/task token, same as Qwen2LM.inference_wrapper
+        if top_ids < llm.speech_token_size:
+            self.output_queue.put(top_ids)
+            self.out_tokens.append(top_ids)
+            if llm.is_looping(self.out_tokens, self.uuid):
+                return True
+            self.lm_input = llm.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+        return self.num_steps == self.max_len
+
+
+class BistreamSession(LLMSession):
+    """Decoding state of one Qwen2LM.inference_bistream request, same text/speech interleaving as inference_bistream.
+
+    A feeder thread iterates the text generator and queues text token pieces, the scheduler consumes one piece
+    per iteration of the text loop of inference_bistream, so the session only becomes ready to forward when
+    it has enough text, and goes back to waiting for text after a fill token.
+    """
+
+    def __init__(self, uuid, llm, text, prompt_text, prompt_speech_token_emb, sampling, cond):
+        super().__init__(uuid, llm.llm_embedding.weight[llm.sos_eos].reshape(1, 1, -1), sampling, 0, float('inf'))
+        self.llm = llm
+        # NOTE init prompt_text as text_cache as it is basically impossible prompt_speech_token/prompt_text < 15/5
+        self.text_cache = llm.llm.model.model.embed_tokens(prompt_text)
+        self.prompt_speech_token_emb = prompt_speech_token_emb
+        self.next_fill_index = -1
+        # NOTE loop guard runs on speech tokens only, same as inference_bistream
+        self.speech_tokens = []
+        self.pieces = deque()
+        self.text_done, self.decoding, self.final = False, False, False
+        threading.Thread(target=self.feed, args=(text, cond), daemon=True).start()
+
+    def feed(self, text, cond):
+        try:
+            for this_text in text:
+                with cond:
+                    self.pieces.append(this_text)
+                    cond.notify()
+        except Exception as e:
+            self.error = e
+        with cond:
+            self.text_done = True
+            cond.notify()
+
+    @torch.inference_mode()
+    def prepare(self):
+        llm, fill_token = self.llm, self.llm.speech_token_size + 2
+        while self.decoding is False and len(self.pieces) != 0:
+            this_text = self.pieces.popleft().to(self.lm_input.device)
+            self.text_cache = torch.concat([self.text_cache, llm.llm.model.model.embed_tokens(this_text)], dim=1)
+            # prompt_speech_token_emb not empty, try append to lm_input
+            while self.prompt_speech_token_emb.size(1) != 0 and self.text_cache.size(1) >= llm.mix_ratio[0]:
+                self.lm_input = torch.concat([self.lm_input, self.text_cache[:, :llm.mix_ratio[0]], self.prompt_speech_token_emb[:, :llm.mix_ratio[1]]], dim=1)
+                self.text_cache, self.prompt_speech_token_emb = self.text_cache[:, llm.mix_ratio[0]:], self.prompt_speech_token_emb[:, llm.mix_ratio[1]:]
+            # no prompt_speech_token_emb remain, can decode some speech token
+            if self.prompt_speech_token_emb.size(1) == 0:
+                after_fill = len(self.out_tokens) != 0 and self.out_tokens[-1] == fill_token
+                if after_fill or (len(self.out_tokens) == 0 and self.lm_input.size(1) == 1):
+                    if self.text_cache.size(1) >= llm.mix_ratio[0]:
+                        lm_input_text = self.text_cache[:, :llm.mix_ratio[0]]
+                        self.lm_input = lm_input_text if after_fill else torch.concat([self.lm_input, lm_input_text], dim=1)
+                        self.text_cache = self.text_cache[:, llm.mix_ratio[0]:]
+                        self.decoding = True
+                else:
+                    self.decoding = True
+        if self.decoding is False and len(self.pieces) == 0 and self.text_done is True and self.error is None:
+            # no more text token, decode until met eos
+            task_id_emb = llm.llm_embedding.weight[llm.task_id].reshape(1, 1, -1)
+            self.lm_input = torch.concat([self.lm_input, self.text_cache, task_id_emb], dim=1)
+            self.decoding, self.final = True, True
+        # NOTE restore after the text stage, which replaces lm_input after a fill token
+        if self.decoding is True:
+            self.restore()
+        return self.decoding
+
+    def ignore_eos(self):
+        return not self.final
+
+    def update(self, llm, top_ids):
+        fill_token = llm.speech_token_size + 2
+        if self.final is False:
+            if self.next_fill_index != -1 and len(self.out_tokens) == self.next_fill_index:
+                top_ids = fill_token
+            if top_ids == fill_token:
+                self.next_fill_index = len(self.out_tokens) + llm.mix_ratio[1] + 1
+        self.out_tokens.append(top_ids)
+        if top_ids >= llm.speech_token_size:
+            if top_ids == fill_token and self.final is False:
+                # wait for more text token
+                self.decoding = False
+                return False
+            if top_ids == llm.speech_token_size and self.final is True:
+                return True
+            raise ValueError('should not get token {}'.format(top_ids))
+        self.output_queue.put(top_ids)
+        self.speech_tokens.append(top_ids)
+        if llm.is_looping(self.speech_tokens, self.uuid):
+            return True
+        self.lm_input = llm.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+        return False
+
+
+class PagedKVCache:
+    """Block based kv cache pool shared by all sessions of the continuous batching scheduler.
+
+    K/V of every layer live in one (num_layers, num_heads, num_blocks * block_size, head_dim) tensor. A session
+    owns a block table of fixed size blocks taken from a free list, so memory is bounded by num_blocks, does not
+    fragment, and free blocks tell how many more sessions can be admitted.
+    """
+
+    def __init__(self, num_blocks: int, block_size: int, num_layers: int, num_heads: int, head_dim: int):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        # allocated on first write with dtype/device of the kv cache
+        self.k_pool, self.v_pool = None, None
+        self.free_blocks = deque(range(num_blocks))
+        self.block_tables = {}
+        self.cache_lens = {}
+        self.peak_used_blocks = 0
+
+    def num_blocks_for(self, num_tokens):
+        return (num_tokens + self.block_size - 1) // self.block_size
+
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    def cache_len(self, uuid):
+        return self.cache_lens.get(uuid, 0)
+
+    def allocate(self, uuid, num_tokens):
+        """Make room for num_tokens more tokens of uuid, return False if there are not enough free blocks."""
+        block_table = self.block_tables.setdefault(uuid, [])
+        num_new_blocks = self.num_blocks_for(self.cache_len(uuid) + num_tokens) - len(block_table)
+        if num_new_blocks > len(self.free_blocks):
+            return False
+        for _ in range(num_new_blocks):
+            block_table.append(self.free_blocks.popleft())
+        self.peak_used_blocks = max(self.peak_used_blocks, self.num_blocks - len(self.free_blocks))
+        return True
+
+    def free(self, uuid):
+        self.free_blocks.extend(self.block_tables.pop(uuid, []))
+        self.cache_lens.pop(uuid, None)
+
+    def slots(self, uuid, start, end, device):
+        block_table = torch.tensor(self.block_tables[uuid], dtype=torch.long, device=device)
+        pos = torch.arange(start, end, device=device)
+        return block_table[pos // self.block_size] * self.block_size + pos % self.block_size
+
+    def gather(self, uuids, max_cache_len):
+        """Left padded legacy kv cache tuple of uuids, padding reads slot 0 and must be masked by attention_mask."""
+        device = self.k_pool.device
+        index = torch.zeros((len(uuids), max_cache_len), dtype=torch.long, device=device)
+        for i, uuid in enumerate(uuids):
+            cache_len = self.cache_len(uuid)
+            if cache_len != 0:
+                index[i, max_cache_len - cache_len:] = self.slots(uuid, 0, cache_len, device)
+        shape = (self.num_layers, self.num_heads, len(uuids), max_cache_len, self.head_dim)
+        k = self.k_pool[:, :, index.view(-1)].view(shape).transpose(1, 2)
+        v = self.v_pool[:, :, index.view(-1)].view(shape).transpose(1, 2)
+        return tuple((k[i], v[i]) for i in range(self.num_layers))
+
+    def write(self, uuids, new_cache, num_new):
+        """Write the last num_new frames of every row of legacy kv cache tuple new_cache after cache_len of uuids."""
+        if self.k_pool is None:
+            k = new_cache[0][0]
+            self.k_pool = torch.zeros((self.num_layers, self.num_heads, self.num_blocks * self.block_size, self.head_dim), dtype=k.dtype, device=k.device)
+            self.v_pool = torch.zeros_like(self.k_pool)
+        index = torch.concat([self.slots(uuid, self.cache_len(uuid), self.cache_len(uuid) + num_new, self.k_pool.device) for uuid in uuids])
+        shape = (self.num_layers, self.num_heads, len(uuids) * num_new, self.head_dim)
+        self.k_pool[:, :, index] = torch.stack([k[:, :, -num_new:] for k, _ in new_cache]).transpose(1, 2).reshape(shape).to(self.k_pool.dtype)
+        self.v_pool[:, :, index] = torch.stack([v[:, :, -num_new:] for _, v in new_cache]).transpose(1, 2).reshape(shape).to(self.v_pool.dtype)
+        for uuid in uuids:
+            self.cache_lens[uuid] = self.cache_len(uuid) + num_new
+
+    def stats(self):
+        # NOTE called from other threads while the scheduler writes, copy cache_lens in one call instead of iterating it
+        used_blocks = self.num_blocks - len(self.free_blocks)
+        used_tokens = sum(list(self.cache_lens.values()))
+        return {'num_blocks': self.num_blocks, 'used_blocks': used_blocks, 'used_tokens': used_tokens,
+                'utilization': used_blocks / self.num_blocks, 'peak_utilization': self.peak_used_blocks / self.num_blocks,
+                'block_fill': used_tokens / (used_blocks * self.block_size) if used_blocks != 0 else 0.0}
+
+
+class ContinuousBatchingScheduler:
+    """Step all running Qwen2LM sessions in one loop, batching their decode forward.
+
+    Sessions are admitted and retired at token boundaries, bistream sessions waiting for text are skipped. A session whose pending
+    lm_input is longer than one frame (prefill) is forwarded alone, all sessions
+    waiting for exactly one speech token are forwarded together with left padded
+    kv cache, so N concurrent requests cost one forward per token instead of N.
+
+    If num_kv_blocks > 0, kv cache of all sessions is kept in a PagedKVCache, sessions are only admitted when
+    there are enough free blocks for their lm_input, and the latest admitted session is preempted and recomputed
+    later if the pool runs out during decoding. Otherwise every session holds its own kv cache tensors.
+    """
+
+    def __init__(self, llm: torch.nn.Module, max_batch_size: int = 16, fp16: bool = False, num_kv_blocks: int = 0, kv_block_size: int = 16):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.fp16 = fp16
+        self.kv_pool = None
+        if num_kv_blocks > 0:
+            config = llm.llm.model.config
+            self.kv_pool = PagedKVCache(num_kv_blocks, kv_block_size, config.num_hidden_layers, config.num_key_value_heads,
+                                        config.hidden_size // config.num_attention_heads)
+        self.num_preempted = 0
+        # repetition window of ras_sampling, only this many decoded tokens are passed to sampling
+        self.history_len = getattr(llm.sampling, 'keywords', {}).get('win_size', 10)
+        self.waiting = deque()
+        self.running = []
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def add_request(self, uuid, lm_input, sampling, min_len, max_len, cache=None):
+        session = LLMSession(uuid, lm_input, sampling, min_len, max_len, cache=cache)
+        with self.cond:
+            self.waiting.append(session)
+            self.cond.notify()
+        return session.output_queue
+
+    def add_bistream_request(self, uuid, text, prompt_text, prompt_speech_token_emb, sampling):
+        with self.cond:
+            session = BistreamSession(uuid, self.llm, text, prompt_text, prompt_speech_token_emb, sampling, self.cond)
+            self.waiting.append(session)
+            self.cond.notify()
+        return session.output_queue
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    while len(self.waiting) != 0 and len(self.running) < self.max_batch_size:
+                        if self.num_blocks_for(self.waiting[0]) > self.kv_pool_size():
+                            # can never be admitted, fail it instead of blocking the queue
+                            session = self.waiting.popleft()
+                            session.output_queue.put(RuntimeError('lm_input of session {} does not fit in {} kv blocks'.format(session.uuid, self.kv_pool_size())))
+                            continue
+                        if not self.can_admit(self.waiting[0]):
+                            break
+                        self.admit(self.waiting.popleft())
+                    for session in [s for s in self.running if s.error is not None]:
+                        self.abort(session, session.error)
+                    # bistream sessions waiting for text are skipped, wait until some session is ready
+                    ready = [s for s in self.running if s.prepare()]
+                    if len(ready) != 0:
+                        break
+                    self.cond.wait()
+            try:
+                self.step(ready)
+            except Exception as e:
+                logging.error('continuous batching step failed, abort {} sessions'.format(len(ready)))
+                for session in ready:
+                    self.abort(session, e)
+
+    def kv_pool_size(self):
+        return float('inf') if self.kv_pool is None else self.kv_pool.num_blocks
+
+    def num_blocks_for(self, session):
+        """Kv blocks session needs to forward its prefix cache, pending inputs and one more token."""
+        if self.kv_pool is None:
+            return 0
+        return self.kv_pool.num_blocks_for(session.num_pending_frames() + (0 if session.prefix_cache is None else session.prefix_cache[0][0].size(2)) + 1)
+
+    def can_admit(self, session):
+        if self.kv_pool is None:
+            return True
+        return self.num_blocks_for(session) <= self.kv_pool.num_free_blocks()
+
+    @torch.inference_mode()
+    def admit(self, session):
+        self.running.append(session)
+        if self.kv_pool is not None and session.prefix_cache is not None:
+            self.kv_pool.allocate(session.uuid, session.prefix_cache[0][0].size(2))
+            self.kv_pool.write([session.uuid], session.prefix_cache, session.prefix_cache[0][0].size(2))
+
+    def preempt(self, session):
+        # drop its kv cache and recompute it from forwarded inputs once admitted again
+        # NOTE lm_input is kept apart, a bistream session waiting for text holds an already forwarded lm_input
+        logging.warning('kv cache pool is full, preempt session {}'.format(session.uuid))
+        if len(session.forwarded) != 0:
+            forwarded = session.forwarded if session.recompute is None else [session.recompute] + session.forwarded
+            session.recompute = torch.concat(forwarded, dim=1)
+        session.forwarded = []
+        with self.cond:
+            self.kv_pool.free(session.uuid)
+            self.running.remove(session)
+            self.waiting.appendleft(session)
+            self.num_preempted += 1
+
+    def reserve(self, plan):
+        """Allocate kv blocks for the frames every (session, num_frames) of plan forwards, preempting the latest admitted sessions."""
+        if self.kv_pool is None:
+            return plan
+        reserved = []
+        for session, num_frames in plan:
+            if session not in self.running:
+                continue
+            while self.kv_pool.allocate(session.uuid, num_frames) is False:
+                victim = self.running[-1]
+                if len(self.running) == 1:
+                    self.abort(session, RuntimeError('kv cache pool of {} blocks is too small for session {}'.format(self.kv_pool.num_blocks, session.uuid)))
+                    break
+                self.preempt(victim)
+                reserved = [(s, n) for s, n in reserved if s is not victim]
+                if victim is session:
+                    break
+            if session in self.running:
+                reserved.append((session, num_frames))
+        return reserved
+
+    def cache_len(self, session):
+        return session.cache_len() if self.kv_pool is None else self.kv_pool.cache_len(session.uuid)
+
+    def read_cache(self, sessions):
+        """Left padded legacy kv cache tuple of sessions, None if all of them are empty."""
+        cache_lens = [self.cache_len(s) for s in sessions]
+        max_cache_len = max(cache_lens)
+        if max_cache_len == 0:
+            return None
+        if self.kv_pool is not None:
+            return self.kv_pool.gather([s.uuid for s in sessions], max_cache_len)
+        return tuple((torch.concat([F.pad(s.cache[j][0], (0, 0, max_cache_len - cache_len, 0)) for s, cache_len in zip(sessions, cache_lens)], dim=0),
+                      torch.concat([F.pad(s.cache[j][1], (0, 0, max_cache_len - cache_len, 0)) for s, cache_len in zip(sessions, cache_lens)], dim=0))
+                     for j in range(len(sessions[cache_lens.index(max_cache_len)].cache)))
+
+    def write_cache(self, sessions, xs, new_cache):
+        """new_cache is the cache of read_cache followed by xs (B, T, D)."""
+        if self.kv_pool is not None:
+            self.kv_pool.write([s.uuid for s in sessions], new_cache, xs.size(1))
+            for i, s in enumerate(sessions):
+                s.forwarded.append(xs[i: i + 1])
+            return
+        for i, s in enumerate(sessions):
+            start = new_cache[0][0].size(2) - s.cache_len() - xs.size(1)
+            s.cache = tuple((k[i: i + 1, :, start:], v[i: i + 1, :, start:]) for k, v in new_cache)
+
+    @torch.inference_mode()
+    def step(self, ready):
+        with torch.cuda.amp.autocast(self.fp16):
+            # prefill at most prefill_chunk_size frames per step, so a long lm_input is interleaved with decode steps of other sessions
+            budget = self.llm.prefill_chunk_size if self.llm.prefill_chunk_size > 0 else float('inf')
+            plan = []
+            for session in ready:
+                if session.lm_input.size(1) == 1:
+                    plan.append((session, 1))
+                elif budget > 0:
+                    plan.append((session, min(budget, session.lm_input.size(1))))
+                    budget -= plan[-1][1]
+            with self.cond:
+                plan = self.reserve(plan)
+            sessions, y_preds = [], []
+            for session, num_frames in [(s, n) for s, n in plan if s.lm_input.size(1) != 1]:
+                xs = session.lm_input[:, :num_frames]
+                seq_len = xs.size(1) + self.cache_len(session)
+                y_pred, new_cache = self.llm.llm.forward_one_step(xs,
+                                                                  masks=torch.tril(torch.ones((1, seq_len, seq_len), device=xs.device)).to(torch.bool),
+                                                                  cache=self.read_cache([session]))
+                self.write_cache([session], xs, new_cache)
+                if num_frames != session.lm_input.size(1):
+                    session.lm_input = session.lm_input[:, num_frames:]
+                    continue
+                sessions.append(session)
+                y_preds.append(y_pred[:, -1])
+            batch = [s for s, _ in plan if s.lm_input.size(1) == 1]
+            if len(batch) != 0:
+                y_pred = self.forward_batch(batch)
+                sessions += batch
+                y_preds.append(y_pred[:, -1])
+            if len(sessions) == 0:
+                return
+            logp = self.llm.llm_decoder(torch.concat(y_preds, dim=0)).log_softmax(dim=-1)
+            # sample all sessions with the same sampling param in one call, history is the last history_len tokens padded with -1
+            decoded_tokens = pad_sequence([torch.tensor(s.out_tokens[-self.history_len:], dtype=torch.long) for s in sessions], batch_first=True, padding_value=-1)
+            ignore_eos = torch.tensor([s.ignore_eos() for s in sessions])
+            groups, top_ids = {}, [None] * len(sessions)
+            for i, session in enumerate(sessions):
+                groups.setdefault(session.sampling, []).append(i)
+            for sampling, index in groups.items():
+                group_top_ids = self.llm.sampling_ids(logp[index], decoded_tokens[index], sampling, ignore_eos=ignore_eos[index]).view(-1).tolist()
+                for i, this_top_ids in zip(index, group_top_ids):
+                    top_ids[i] = this_top_ids
+            for session, this_top_ids in zip(sessions, top_ids):
+                try:
+                    finished = session.update(self.llm, this_top_ids)
+                except Exception as e:
+                    self.abort(session, e)
+                    continue
+                if finished is True:
+                    self.finish(session)
+
+    def forward_batch(self, batch):
+        cache_lens = [self.cache_len(s) for s in batch]
+        max_cache_len = max(cache_lens)
+        device = batch[0].lm_input.device
+        xs = torch.concat([s.lm_input for s in batch], dim=0)
+        # left pad kv cache so that every session ends at the same position
+        attention_mask = torch.zeros((len(batch), max_cache_len + 1), dtype=torch.long, device=device)
+        for i, cache_len in enumerate(cache_lens):
+            attention_mask[i, max_cache_len - cache_len:] = 1
+        position_ids = torch.tensor(cache_lens, dtype=torch.long, device=device).unsqueeze(dim=1)
+        y_pred, new_cache = self.llm.llm.forward_batch_step(xs, attention_mask, position_ids, self.read_cache(batch))
+        self.write_cache(batch, xs, new_cache)
+        return y_pred
+
+    # NOTE running, waiting and kv_pool are read by stats() from other threads, only change them under cond,
+    # which is reentrant, so these are also called from loop() and reserve() holding it
+    def finish(self, session):
+        session.output_queue.put(None)
+        with self.cond:
+            self.running.remove(session)
+            if self.kv_pool is not None:
+                self.kv_pool.free(session.uuid)
+
+    def abort(self, session, e):
+        with self.cond:
+            if session in self.running:
+                session.output_queue.put(e)
+                self.running.remove(session)
+                if self.kv_pool is not None:
+                    self.kv_pool.free(session.uuid)
+
+    def stats(self):
+        with self.cond:
+            stats = {'running': len(self.running), 'waiting': len(self.waiting), 'preempted': self.num_preempted}
+            if self.kv_pool is not None:
+                stats.update(self.kv_pool.stats())
+        return stats
@@ -133,7 +133,8 @@ class MultiHeadedAttention(nn.Module):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_in_place: bool = False
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute scaled dot product attention.
 
@@ -156,6 +157,9 @@ class MultiHeadedAttention(nn.Module):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_in_place (bool): cache is a view of a preallocated buffer
+                (1, head, cache_t + time1, d_k * 2), KEY & VALUE of the input
+                are written into its last time1 frames instead of concat.
 
 
         Returns:
@@ -183,15 +187,20 @@ class MultiHeadedAttention(nn.Module):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        if cache_in_place:
+            cache[:, :, cache.size(2) - k.size(2):] = torch.cat((k, v), dim=-1)
+            k, v = torch.split(cache, cache.size(-1) // 2, dim=-1)
+            new_cache = cache
+        else:
+            if cache.size(0) > 0:
+                key_cache, value_cache = torch.split(cache,
+                                                     cache.size(-1) // 2,
+                                                     dim=-1)
+                k = torch.cat([key_cache, k], dim=2)
+                v = torch.cat([value_cache, v], dim=2)
+            # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
+            #   non-trivial to calculate `next_cache_start` here.
+            new_cache = torch.cat((k, v), dim=-1)
 
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
@@ -253,7 +262,8 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_in_place: bool = False
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute 'Scaled Dot Product Attention' with rel. positional encoding.
         Args:
@@ -267,6 +277,9 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_in_place (bool): cache is a view of a preallocated buffer
+                (1, head, cache_t + time1, d_k * 2), KEY & VALUE of the input
+                are written into its last time1 frames instead of concat.
         Returns:
             torch.Tensor: Output tensor (#batch, time1, d_model).
             torch.Tensor: Cache tensor (1, head, cache_t + time1, d_k * 2)
@@ -292,15 +305,20 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        if cache_in_place:
+            cache[:, :, cache.size(2) - k.size(2):] = torch.cat((k, v), dim=-1)
+            k, v = torch.split(cache, cache.size(-1) // 2, dim=-1)
+            new_cache = cache
+        else:
+            if cache.size(0) > 0:
+                key_cache, value_cache = torch.split(cache,
+                                                     cache.size(-1) // 2,
+                                                     dim=-1)
+                k = torch.cat([key_cache, k], dim=2)
+                v = torch.cat([value_cache, v], dim=2)
+            # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
+            #   non-trivial to calculate `next_cache_start` here.
+            new_cache = torch.cat((k, v), dim=-1)
 
         n_batch_pos = pos_emb.size(0)
         p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
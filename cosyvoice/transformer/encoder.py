@@ -271,6 +271,60 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    @torch.jit.unused
+    def init_att_cache(self, capacity: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+        """Preallocated att_cache (elayers, head, capacity, d_k * 2) for forward_chunk_in_place."""
+        self_attn = self.encoders[0].self_attn
+        return torch.zeros((len(self.encoders), self_attn.h, capacity, self_attn.d_k * 2), device=device, dtype=dtype)
+
+    @torch.jit.unused
+    def forward_chunk_in_place(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        att_cache: torch.Tensor,
+        att_mask: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Same as forward_chunk with required_cache_size=-1 and all
+            history in att_cache, but att_cache is updated in place
+
+        forward_chunk concats KEY & VALUE of every layer to the whole cache
+        and concats all layers again, so every step copies the cache. Here
+        KEY & VALUE of xs are written into frames offset ... offset + time
+        of the preallocated att_cache, and attention reads a view of it.
+        Only transformer layers are supported, conformer cnn cache is not.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b=1, time, mel-dim)
+            offset (int): number of valid frames in att_cache
+            att_cache (torch.Tensor): cache tensor from init_att_cache,
+                (elayers, head, capacity, d_k * 2), it is doubled and
+                copied if offset + time exceeds capacity
+            att_mask (torch.Tensor): (1, time, offset + time)
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b=1, time, hidden-dim).
+            torch.Tensor: att_cache, a new tensor only if it has grown.
+        """
+        assert xs.size(0) == 1
+        assert all(isinstance(layer, TransformerEncoderLayer) for layer in self.encoders), 'forward_chunk_in_place only supports transformer layers!'
+        tmp_masks = torch.ones(1, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
+        attention_key_size = offset + xs.size(1)
+        if attention_key_size > att_cache.size(2):
+            att_cache = torch.concat([att_cache, torch.zeros_like(att_cache[:, :, :max(att_cache.size(2), attention_key_size - att_cache.size(2))])], dim=2)
+        pos_emb = self.embed.position_encoding(offset=0, size=attention_key_size)
+        for i, layer in enumerate(self.encoders):
+            xs, _, _, _ = layer(xs, att_mask, pos_emb,
+                                att_cache=att_cache[i:i + 1, :, :attention_key_size],
+                                att_cache_in_place=True)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs, att_cache
+
     @torch.jit.unused
     def forward_chunk_by_chunk(
         self,
@@ -63,6 +63,7 @@ class TransformerEncoderLayer(nn.Module):
         mask_pad: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         att_cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
         cnn_cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        att_cache_in_place: bool = False,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """Compute encoded features.
 
@@ -79,6 +80,9 @@ class TransformerEncoderLayer(nn.Module):
             cnn_cache (torch.Tensor): Convolution cache in conformer layer
                 (#batch=1, size, cache_t2), not used here, it's for interface
                 compatibility to ConformerEncoderLayer.
+            att_cache_in_place (bool): att_cache is a view of a preallocated
+                buffer (#batch=1, head, cache_t1 + time, d_k * 2) whose last
+                time frames are filled in place, see BaseEncoder.forward_chunk_in_place.
         Returns:
             torch.Tensor: Output tensor (#batch, time, size).
             torch.Tensor: Mask tensor (#batch, time, time).
@@ -90,7 +94,7 @@ class TransformerEncoderLayer(nn.Module):
         residual = x
         if self.normalize_before:
             x = self.norm1(x)
-        x_att, new_att_cache = self.self_attn(x, x, x, mask, pos_emb=pos_emb, cache=att_cache)
+        x_att, new_att_cache = self.self_attn(x, x, x, mask, pos_emb=pos_emb, cache=att_cache, cache_in_place=att_cache_in_place)
         x = residual + self.dropout(x_att)
         if not self.normalize_before:
             x = self.norm1(x)
@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 
 import torch
 from torch import nn
@@ -31,7 +31,7 @@ from cosyvoice.utils.class_utils import (
     COSYVOICE_ACTIVATION_CLASSES,
 )
 from cosyvoice.utils.mask import make_pad_mask
-from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import add_optional_chunk_mask, subsequent_chunk_mask
 
 
 class Upsample1D(nn.Module):
@@ -62,6 +62,16 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, cache: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Streaming forward, cache (B, C, <= 2) holds the last input frames of previous chunks."""
+        outputs = torch.concat([cache, inputs], dim=2)
+        new_cache = outputs[:, :, -2:]
+        outputs = F.interpolate(outputs, scale_factor=float(self.stride), mode="nearest")
+        # NOTE frames before the sequence start are zero padded, same as forward
+        outputs = F.pad(outputs, (self.stride * 2 - self.stride * cache.size(2), 0), value=0.0)
+        outputs = self.conv(outputs)
+        return outputs, new_cache
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, channels: int, pre_lookahead_len: int = 1):
@@ -101,6 +111,26 @@ class PreLookaheadLayer(nn.Module):
         outputs = outputs + inputs
         return outputs
 
+    def forward_chunk(self, inputs: torch.Tensor, context: torch.Tensor, cache: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Streaming forward of new frames.
+
+        inputs: (batch_size, seq_len, channels)
+        context: (batch_size, <= pre_lookahead_len, channels) frames after inputs, zero padded if shorter
+        cache: (batch_size, <= conv2.kernel_size - 1, channels) last inputs of previous chunks
+        """
+        outputs = torch.concat([cache, inputs], dim=1)
+        new_cache = outputs[:, -(self.conv2.kernel_size[0] - 1):]
+        outputs = torch.concat([outputs, context], dim=1).transpose(1, 2).contiguous()
+        outputs = F.pad(outputs, (0, self.pre_lookahead_len - context.size(1)), mode='constant', value=0.0)
+        outputs = F.leaky_relu(self.conv1(outputs))
+        # NOTE conv1 outputs before the sequence start are zero padded, same as forward
+        outputs = F.pad(outputs, (self.conv2.kernel_size[0] - 1 - cache.size(1), 0), mode='constant', value=0.0)
+        outputs = self.conv2(outputs)
+        outputs = outputs.transpose(1, 2).contiguous()
+
+        outputs = outputs + inputs
+        return outputs, new_cache
+
 
 class UpsampleConformerEncoder(torch.nn.Module):
 
@@ -305,6 +335,68 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: torch.Tensor = torch.zeros(0, 0, 0),
+        cache: Optional[Dict] = None,
+    ) -> Tuple[torch.Tensor, Dict]:
+        """Streaming inference, only encode xs given the cache of all previous chunks.
+
+        Args:
+            xs: new input frames (1, T, D)
+            context: lookahead frames after xs (1, <= pre_lookahead_len, D), empty for the last chunk
+            cache: returned by the previous call, None for the first chunk
+        Returns:
+            encoder output of xs (1, T * up_layer.stride, D) and the new cache
+        NOTE every chunk except the last one must end at a multiple of static_chunk_size,
+            then the output equals the corresponding part of forward(streaming=True).
+        """
+        if cache is None:
+            cache = {'offset': 0,
+                     'pre_lookahead': torch.zeros(xs.size(0), 0, xs.size(2), device=xs.device, dtype=xs.dtype),
+                     'att_cache': [torch.zeros((0, 0, 0, 0))] * len(self.encoders),
+                     'up_layer': torch.zeros(xs.size(0), xs.size(2), 0, device=xs.device, dtype=xs.dtype),
+                     'up_att_cache': [torch.zeros((0, 0, 0, 0))] * len(self.up_encoders)}
+        offset = cache['offset']
+        T = xs.size(1)
+        masks = torch.ones(xs.size(0), 1, T, dtype=torch.bool, device=xs.device)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        # NOTE pos_emb covers cache + xs, rel_shift in attention then gives the same relative positions as forward
+        xs, pos_emb, masks = self.embed(xs, masks, offset=offset)
+        if context.size(1) != 0:
+            context, _, _ = self.embed(context, torch.ones(1, 1, context.size(1)).to(masks), offset=offset + T)
+        else:
+            context = xs[:, :0]
+        xs, pre_lookahead_cache = self.pre_lookahead_layer.forward_chunk(xs, context, cache['pre_lookahead'])
+        chunk_masks = subsequent_chunk_mask(offset + T, self.static_chunk_size, device=xs.device)[offset:].unsqueeze(dim=0)
+        att_cache = []
+        for layer, layer_cache in zip(self.encoders, cache['att_cache']):
+            xs, _, new_layer_cache, _ = layer(xs, chunk_masks, pos_emb, att_cache=layer_cache)
+            att_cache.append(new_layer_cache)
+
+        new_offset = offset + T
+        xs, up_layer_cache = self.up_layer.forward_chunk(xs.transpose(1, 2).contiguous(), cache['up_layer'])
+        xs = xs.transpose(1, 2).contiguous()
+        up_offset, T = offset * self.up_layer.stride, xs.size(1)
+        masks = torch.ones(xs.size(0), 1, T, dtype=torch.bool, device=xs.device)
+        xs, pos_emb, masks = self.up_embed(xs, masks, offset=up_offset)
+        chunk_masks = subsequent_chunk_mask(up_offset + T, self.static_chunk_size * self.up_layer.stride, device=xs.device)[up_offset:].unsqueeze(dim=0)
+        up_att_cache = []
+        for layer, layer_cache in zip(self.up_encoders, cache['up_att_cache']):
+            xs, _, new_layer_cache, _ = layer(xs, chunk_masks, pos_emb, att_cache=layer_cache)
+            up_att_cache.append(new_layer_cache)
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        new_cache = {'offset': new_offset,
+                     'pre_lookahead': pre_lookahead_cache,
+                     'att_cache': att_cache,
+                     'up_layer': up_layer_cache,
+                     'up_att_cache': up_att_cache}
+        return xs, new_cache
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
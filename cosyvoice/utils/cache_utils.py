@@ -0,0 +1,115 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import torch
+from cosyvoice.utils.file_utils import logging
+
+
+class LRUCache:
+    """Thread safe in-memory LRU of at most max_size entries, max_size <= 0 disables it."""
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_size:
+                self.memory.popitem(last=False)
+
+    def __len__(self):
+        return len(self.memory)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.memory)}
+
+
+class PromptCache:
+    """Two tier cache of prompt side frontend results, keyed by content hash.
+
+    The key is the sha256 of the 16k prompt audio samples, the prompt text and the resample rate,
+    so the same reference voice sent again skips resampling, feat/token extraction and campplus.
+    The memory tier is an LRU of at most max_size entries, evicted entries stay in the
+    disk tier (one torch.save file per key under cache_dir) if cache_dir is set.
+    """
+
+    def __init__(self, max_size: int = 64, cache_dir: str = '', device: torch.device = torch.device('cpu')):
+        self.cache_dir = cache_dir
+        self.device = device
+        self.memory = LRUCache(max_size)
+        self.lock = threading.Lock()
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+        if self.cache_dir != '':
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(prompt_text, prompt_speech_16k, resample_rate):
+        m = hashlib.sha256()
+        m.update(prompt_speech_16k.detach().cpu().float().contiguous().numpy().tobytes())
+        m.update('{}|{}'.format(prompt_text, resample_rate).encode('utf-8'))
+        return m.hexdigest()
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            with self.lock:
+                self.hits += 1
+            return dict(value)
+        if self.cache_dir != '' and os.path.exists(self._disk_path(key)):
+            try:
+                value = torch.load(self._disk_path(key), map_location=self.device)
+            except Exception as e:
+                logging.warning('failed to load prompt cache {}, {}'.format(self._disk_path(key), e))
+            else:
+                self.memory.put(key, value)
+                with self.lock:
+                    self.disk_hits += 1
+                return dict(value)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.memory.put(key, dict(value))
+        if self.cache_dir != '':
+            # write to a temporary file first, concurrent readers never see a partial file
+            tmp_path = '{}.{}.tmp'.format(self._disk_path(key), threading.get_ident())
+            torch.save({k: v.cpu() if isinstance(v, torch.Tensor) else v for k, v in value.items()}, tmp_path)
+            os.replace(tmp_path, self._disk_path(key))
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'size': len(self.memory)}
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, '{}.pt'.format(key))
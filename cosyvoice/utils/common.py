@@ -108,35 +108,85 @@ def init_weights(m, mean=0.0, std=0.01):
 
 
 # Repetition Aware Sampling in VALL-E 2
-def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
-    top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
+# weighted_scores is (V,) or (B, V), decoded_tokens is a list or a (B, T) history padded with -1,
+# ignore_mask is a bool mask broadcastable to weighted_scores of token ids which must not be sampled
+def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1, ignore_mask=None):
+    scores = weighted_scores.view(-1, weighted_scores.size(-1))
+    if isinstance(decoded_tokens, list):
+        decoded_tokens = torch.tensor(decoded_tokens[-win_size:], dtype=torch.long)
+    decoded_tokens = decoded_tokens.to(scores.device).view(scores.size(0), -1)[:, -win_size:]
+    top_ids = nucleus_sampling(scores, top_p=top_p, top_k=top_k, ignore_mask=ignore_mask)
+    rep_num = (decoded_tokens == top_ids).sum(dim=1, keepdim=True)
+    # NOTE always draw the fallback sample, selecting it with where avoids a device sync per token
+    random_ids = random_sampling(scores, decoded_tokens, sampling, ignore_mask=ignore_mask)
+    top_ids = torch.where(rep_num >= win_size * tau_r, random_ids, top_ids)
+    return top_ids.view(weighted_scores.shape[:-1] + (1,))
+
+
+def nucleus_candidates(weighted_scores, top_p=0.8, top_k=25, ignore_mask=None):
+    """Unnormalized probs (..., top_k) of nucleus candidates and their ids, non candidates have zero prob."""
+    prob = weighted_scores.softmax(dim=-1)
+    sorted_value, sorted_idx = prob.sort(dim=-1, descending=True, stable=True)
+    sorted_value, sorted_idx = sorted_value[..., :top_k], sorted_idx[..., :top_k]
+    # sampling both top-p and numbers, keep a candidate if cumulative prob before it is less than top_p
+    nucleus_value = sorted_value * ((sorted_value.cumsum(dim=-1) - sorted_value) < top_p)
+    if ignore_mask is not None:
+        # ignored ids get zero prob in both the nucleus and the random fallback, fall back to top-k if only ignored ids are left.
+        # NOTE this approximates rejecting them after sampling but is not the same distribution, the nucleus is cut before
+        # masking and ras decides on the repetition of the masked sample instead of resampling the whole step
+        ignored = ignore_mask.expand_as(prob).gather(-1, sorted_idx)
+        sorted_value, nucleus_value = sorted_value.masked_fill(ignored, 0), nucleus_value.masked_fill(ignored, 0)
+        nucleus_value = torch.where(nucleus_value.sum(dim=-1, keepdim=True) == 0, sorted_value, nucleus_value)
+    return nucleus_value, sorted_idx
+
+
+def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25, ignore_mask=None):
+    nucleus_value, sorted_idx = nucleus_candidates(weighted_scores, top_p=top_p, top_k=top_k, ignore_mask=ignore_mask)
+    top_ids = sorted_idx.gather(-1, nucleus_value.multinomial(1, replacement=True))
     return top_ids
 
 
-def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
+def random_sampling(weighted_scores, decoded_tokens, sampling, ignore_mask=None):
+    prob = weighted_scores.softmax(dim=-1)
+    if ignore_mask is not None:
+        prob = prob.masked_fill(ignore_mask, 0)
+    top_ids = prob.multinomial(1, replacement=True)
     return top_ids
 
 
-def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
-    return top_ids
+def ras_sampling_prob(weighted_scores, decoded_tokens, top_p=0.8, top_k=25, win_size=10, tau_r=0.1, ignore_mask=None):
+    """(B, V) distribution which ras_sampling draws from given (B, V) scores and (B, T) history padded with -1.
+
+    A nucleus sample which repeats at least win_size * tau_r times in the window is replaced by a random sample,
+    so prob = nucleus prob of not repeated ids + nucleus mass of repeated ids * random prob.
+    """
+    nucleus_value, sorted_idx = nucleus_candidates(weighted_scores, top_p=top_p, top_k=top_k, ignore_mask=ignore_mask)
+    nucleus_prob = torch.zeros_like(weighted_scores, dtype=torch.float).scatter(-1, sorted_idx, nucleus_value.float())
+    nucleus_prob = nucleus_prob / nucleus_prob.sum(dim=-1, keepdim=True)
+    random_prob = weighted_scores.float().softmax(dim=-1)
+    if ignore_mask is not None:
+        random_prob = random_prob.masked_fill(ignore_mask, 0)
+    random_prob = random_prob / random_prob.sum(dim=-1, keepdim=True)
+    decoded_tokens = decoded_tokens[:, -win_size:]
+    rep_num = torch.zeros_like(nucleus_prob).scatter_add(-1, decoded_tokens.clamp(min=0), (decoded_tokens >= 0).float())
+    repeated = rep_num >= win_size * tau_r
+    return nucleus_prob.masked_fill(repeated, 0) + (nucleus_prob * repeated).sum(dim=-1, keepdim=True) * random_prob
+
+
+def detect_token_loop(tokens, token_frame_rate=25, max_period=10, min_loop_seconds=10.0):
+    """Detect degenerate decoding at the end of generated speech tokens, called once per new token.
+
+    Return 'repetition' if the last min_loop_seconds of tokens repeat a pattern of at most max_period tokens,
+    None otherwise. min_loop_seconds is converted with token_frame_rate, so set it to the model's token rate
+    (25 for CosyVoice2, 50 for CosyVoice) and keep it well above the longest pause or sustained sound.
+    """
+    min_loop_len = int(min_loop_seconds * token_frame_rate)
+    for period in range(1, max_period + 1):
+        if len(tokens) < min_loop_len + period:
+            break
+        if tokens[-min_loop_len:] == tokens[-min_loop_len - period: -period]:
+            return 'repetition'
+    return None
 
 
 def fade_in_out(fade_in_mel, fade_out_mel, window):
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import sys
+import time
+import torch
+sys.path.append('third_party/Matcha-TTS')
+from cosyvoice.cli.cosyvoice import CosyVoice2
+from cosyvoice.utils.file_utils import load_wav
+from cosyvoice.utils.common import set_all_random_seed
+
+# (solver, n_timesteps), nfe of fixed step solvers is n_timesteps for euler/ab2 and 2 * n_timesteps for midpoint/heun
+CANDIDATES = [('euler', 10), ('euler', 5), ('euler', 4),
+              ('ab2', 6), ('ab2', 5), ('ab2', 4),
+              ('midpoint', 3), ('midpoint', 2),
+              ('heun', 3), ('heun', 2),
+              ('adaptive', 3)]
+# (inference_cfg_interval, inference_cfg_reuse_steps) evaluated with euler 10 steps
+CFG_CANDIDATES = [((0.0, 1.0), 1), ((0.0, 1.0), 2), ((0.0, 0.5), 0), ((0.2, 0.8), 0)]
+
+
+def flow_inference(model_input, token, solver, n_timesteps):
+    device = cosyvoice.model.device
+    with torch.cuda.amp.autocast(cosyvoice.model.fp16):
+        mel, _ = cosyvoice.model.flow.inference(token=token.to(device),
+                                                token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(device),
+                                                prompt_token=model_input['flow_prompt_speech_token'].to(device),
+                                                prompt_token_len=model_input['flow_prompt_speech_token_len'].to(device),
+                                                prompt_feat=model_input['prompt_speech_feat'].to(device),
+                                                prompt_feat_len=model_input['prompt_speech_feat_len'].to(device),
+                                                embedding=model_input['flow_embedding'].to(device),
+                                                streaming=False,
+                                                finalize=True,
+                                                n_timesteps=n_timesteps,
+                                                solver=solver)
+    return mel
+
+
+def timeit(func):
+    # warmup
+    func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(args.num_repeat):
+        mel = func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return mel, (time.time() - start_time) / args.num_repeat
+
+
+def main(args):
+    model_input = cosyvoice.frontend.frontend_zero_shot(args.tts_text, args.prompt_text, prompt_speech_16k, cosyvoice.sample_rate, '')
+    set_all_random_seed(0)
+    device = cosyvoice.model.device
+    with torch.cuda.amp.autocast(cosyvoice.model.fp16):
+        token = list(cosyvoice.model.llm.inference(text=model_input['text'].to(device),
+                                                   text_len=model_input['text_len'].to(device),
+                                                   prompt_text=model_input['prompt_text'].to(device),
+                                                   prompt_text_len=model_input['prompt_text_len'].to(device),
+                                                   prompt_speech_token=model_input['llm_prompt_speech_token'].to(device),
+                                                   prompt_speech_token_len=model_input['llm_prompt_speech_token_len'].to(device),
+                                                   embedding=model_input['llm_embedding'].to(device)))
+    token = torch.tensor([token], dtype=torch.int32)
+    reference = flow_inference(model_input, token, 'euler', 10)
+    print('{} speech tokens, reference euler 10 steps'.format(token.shape[1]))
+    for solver, n_timesteps in CANDIDATES:
+        mel, cost = timeit(lambda: flow_inference(model_input, token, solver, n_timesteps))
+        print('solver {:<9} n_timesteps {:<2} mel l1 {:.4f} time {:.3f}s'.format(solver, n_timesteps, (mel - reference).abs().mean().item(), cost))
+    decoder = cosyvoice.model.flow.decoder
+    for cfg_interval, cfg_reuse_steps in CFG_CANDIDATES:
+        decoder.inference_cfg_interval, decoder.inference_cfg_reuse_steps = cfg_interval, cfg_reuse_steps
+        mel, cost = timeit(lambda: flow_inference(model_input, token, 'euler', 10))
+        print('cfg interval {} reuse steps {} mel l1 {:.4f} time {:.3f}s'.format(cfg_interval, cfg_reuse_steps, (mel - reference).abs().mean().item(), cost))
+    decoder.inference_cfg_interval, decoder.inference_cfg_reuse_steps = (0.0, 1.0), 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice2-0.5B')
+    parser.add_argument('--prompt_wav', type=str, default='asset/zero_shot_prompt.wav')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--num_repeat', type=int, default=5)
+    parser.add_argument('--load_trt', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+
+    cosyvoice = CosyVoice2(args.model_dir, load_trt=args.load_trt, fp16=args.fp16)
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    main(args)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import time
+import numpy as np
+import torch
+from cosyvoice.hifigan.generator import SineGen, SineGen2, HiFTStream, HiFTGenerator
+from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor
+
+
+def legacy_f_mat(sinegen, f0):
+    # harmonics filled one by one, as SineGen did before
+    F_mat = torch.zeros((f0.size(0), sinegen.harmonic_num + 1, f0.size(-1))).to(f0.device)
+    for i in range(sinegen.harmonic_num + 1):
+        F_mat[:, i: i + 1, :] = f0 * (i + 1) / sinegen.sampling_rate
+    return F_mat
+
+
+def legacy_f02sine(sinegen, f0):
+    # interpolate down, cumsum and interpolate up, as SineGen2 did before
+    fn = torch.multiply(f0, torch.FloatTensor([[range(1, sinegen.harmonic_num + 2)]]).to(f0.device))
+    rad_values = (fn / sinegen.sampling_rate) % 1
+    rad_values = torch.nn.functional.interpolate(rad_values.transpose(1, 2), scale_factor=1 / sinegen.upsample_scale, mode="linear").transpose(1, 2)
+    phase = torch.cumsum(rad_values, dim=1) * 2 * np.pi
+    phase = torch.nn.functional.interpolate(phase.transpose(1, 2) * sinegen.upsample_scale, scale_factor=sinegen.upsample_scale, mode="linear").transpose(1, 2)
+    return torch.sin(phase)
+
+
+def random_f0(num_frames, upsample_scale, voiced=True):
+    # smooth contour between 80 and 300 Hz, nearest upsampled as HiFTGenerator.f0_upsamp
+    f0 = 190 + 110 * torch.sin(torch.cumsum(torch.rand(num_frames) * 0.2, dim=0))
+    if voiced is False:
+        f0[torch.rand(num_frames) < 0.2] = 0
+    return f0.to(args.device).repeat_interleave(upsample_scale).view(1, -1, 1)
+
+
+def timeit(func, *inputs):
+    func(*inputs)
+    if args.device == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(args.num_repeat):
+        func(*inputs)
+    if args.device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / args.num_repeat * 1000
+
+
+def vectorized_f_mat(sinegen, f0):
+    return f0 * torch.arange(1, sinegen.harmonic_num + 2, device=f0.device).view(1, -1, 1) / sinegen.sampling_rate
+
+
+def vectorized_f02sine(sinegen, f0):
+    return sinegen._f02sine(f0 * torch.arange(1, sinegen.harmonic_num + 2, device=f0.device))
+
+
+def forward(sinegen, f0):
+    # f0 (B, T, 1), SineGen takes (B, 1, T), return sines (B, T, dim)
+    if isinstance(sinegen, SineGen):
+        return sinegen(f0.transpose(1, 2))[0].transpose(1, 2)
+    return sinegen(f0)[0]
+
+
+def stream(sinegen, f0, num_frames, upsample_scale):
+    # feed num_frames frames per chunk, return the concatenated sines
+    hift_state, outputs = HiFTStream(), []
+    for start in range(0, f0.size(1), num_frames * upsample_scale):
+        hift_state.finalize = start + num_frames * upsample_scale >= f0.size(1)
+        chunk = f0[:, start: start + num_frames * upsample_scale]
+        if isinstance(sinegen, SineGen):
+            outputs.append(sinegen(chunk.transpose(1, 2), hift_state)[0].transpose(1, 2))
+        else:
+            outputs.append(sinegen(chunk, hift_state)[0])
+    return torch.concat(outputs, dim=1)
+
+
+def build_hift(sampling_rate, conv_istft):
+    # CosyVoice/CosyVoice2 hift configs with random weights, no noise and every frame voiced (f0 >= 0 > threshold),
+    # so that the only randomness is the initial phase of SineGen, and no output clipping to hide differences
+    torch.manual_seed(0)
+    if sampling_rate == 22050:
+        upsample_rates, upsample_kernel_sizes = [8, 8], [16, 16]
+        source_resblock_kernel_sizes, source_resblock_dilation_sizes = [7, 11], [[1, 3, 5], [1, 3, 5]]
+    else:
+        upsample_rates, upsample_kernel_sizes = [8, 5, 3], [16, 11, 7]
+        source_resblock_kernel_sizes, source_resblock_dilation_sizes = [7, 7, 11], [[1, 3, 5], [1, 3, 5], [1, 3, 5]]
+    hift = HiFTGenerator(sampling_rate=sampling_rate, nsf_sigma=0, nsf_voiced_threshold=-1, upsample_rates=upsample_rates,
+                         upsample_kernel_sizes=upsample_kernel_sizes, source_resblock_kernel_sizes=source_resblock_kernel_sizes,
+                         source_resblock_dilation_sizes=source_resblock_dilation_sizes, audio_limit=float('inf'),
+                         f0_predictor=ConvRNNF0Predictor(num_class=1, in_channels=80, cond_channels=512), conv_istft=conv_istft)
+    return hift.to(args.device).eval()
+
+
+def hift_stream(hift, mel, chunk_sizes):
+    # feed chunk_sizes frames per chunk, then an empty finalize chunk, return the concatenated speech
+    hift_state, outputs, start = None, [], 0
+    for num_frames in chunk_sizes:
+        speech, hift_state = hift.inference_stream(mel[:, :, start: start + num_frames], hift_state)
+        outputs.append(speech)
+        start += num_frames
+    speech, hift_state = hift.inference_stream(mel[:, :, start: start], hift_state, finalize=True)
+    outputs.append(speech)
+    return torch.concat(outputs, dim=1)
+
+
+@torch.inference_mode()
+def main(args):
+    # CosyVoice 22.05kHz hift uses SineGen, CosyVoice2 24kHz hift uses SineGen2, both with 8 harmonics
+    for sampling_rate, upsample_scale in [(22050, 256), (24000, 480)]:
+        if sampling_rate == 22050:
+            sinegen = SineGen(sampling_rate, harmonic_num=8, sine_amp=0.1, noise_std=0)
+            legacy, vectorized = legacy_f_mat, vectorized_f_mat
+        else:
+            sinegen = SineGen2(sampling_rate, upsample_scale, harmonic_num=8, sine_amp=0.1, noise_std=0)
+            legacy, vectorized = legacy_f02sine, vectorized_f02sine
+        for num_frames in args.num_frames:
+            f0 = random_f0(num_frames, upsample_scale, voiced=False)
+            f0_in = f0.transpose(1, 2) if sampling_rate == 22050 else f0
+            diff = (legacy(sinegen, f0_in) - vectorized(sinegen, f0_in)).abs().max().item()
+            cost_legacy, cost = timeit(legacy, sinegen, f0_in), timeit(vectorized, sinegen, f0_in)
+            print('{}Hz chunk {} frames {} samples: legacy {:.3f}ms vectorized {:.3f}ms max diff {:.2e}, forward {:.3f}ms'.format(
+                  sampling_rate, num_frames, f0.size(1), cost_legacy, cost, diff, timeit(forward, sinegen, f0)))
+
+        # phase carried across chunks, voiced only and no noise so that sines of full and streaming inference are comparable
+        f0 = random_f0(max(args.num_frames) * 4, upsample_scale)
+        torch.manual_seed(0)
+        full = forward(sinegen, f0)
+        for num_frames in args.num_frames:
+            torch.manual_seed(0)
+            diff = (stream(sinegen, f0, num_frames, upsample_scale) - full).abs().max().item()
+            cost = timeit(stream, sinegen, f0, num_frames, upsample_scale) / -(-f0.size(1) // (num_frames * upsample_scale))
+            print('{}Hz streaming chunk {} frames: {:.3f}ms per chunk, max diff to full inference {:.2e}'.format(sampling_rate, num_frames, cost, diff))
+
+        # whole HiFTGenerator, covers conv_transpose, reflect padding, align/add of branches and the istft overlap
+        for conv_istft in [False, True]:
+            hift = build_hift(sampling_rate, conv_istft)
+            mel = torch.randn(1, 80, sum(args.hift_chunk_sizes), device=args.device)
+            torch.manual_seed(0)
+            full = hift.inference(mel)[0]
+            torch.manual_seed(0)
+            speech = hift_stream(hift, mel, args.hift_chunk_sizes)
+            assert speech.shape == full.shape, 'inference_stream output {} samples, inference {}'.format(speech.size(1), full.size(1))
+            print('{}Hz hift conv_istft {} inference_stream chunks {} + finalize: max diff to inference {:.2e}'.format(
+                  sampling_rate, conv_istft, args.hift_chunk_sizes, (speech - full).abs().max().item()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_frames', type=int, nargs='+', default=[25, 50, 100, 200], help='mel frames per chunk')
+    parser.add_argument('--hift_chunk_sizes', type=int, nargs='+', default=[1, 7, 1, 24, 2, 50, 3, 40],
+                        help='mel frames of every inference_stream chunk before the empty finalize chunk')
+    parser.add_argument('--num_repeat', type=int, default=20)
+    parser.add_argument('--gpu', action='store_true', help='benchmark on gpu, default on cpu')
+    args = parser.parse_args()
+    args.device = 'cuda' if args.gpu else 'cpu'
+    main(args)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import os
+import sys
+import time
+import torch
+sys.path.append('third_party/Matcha-TTS')
+from cosyvoice.cli.cosyvoice import CosyVoice2
+from cosyvoice.utils.file_utils import load_wav
+from cosyvoice.utils.common import set_all_random_seed
+
+
+def llm_inference(model_input):
+    device = cosyvoice.model.device
+    with torch.cuda.amp.autocast(cosyvoice.model.fp16):
+        return list(cosyvoice.model.llm.inference(text=model_input['text'].to(device),
+                                                  text_len=model_input['text_len'].to(device),
+                                                  prompt_text=model_input['prompt_text'].to(device),
+                                                  prompt_text_len=model_input['prompt_text_len'].to(device),
+                                                  prompt_speech_token=model_input['llm_prompt_speech_token'].to(device),
+                                                  prompt_speech_token_len=model_input['llm_prompt_speech_token_len'].to(device),
+                                                  embedding=model_input['llm_embedding'].to(device)))
+
+
+def main(args):
+    model_input = cosyvoice.frontend.frontend_zero_shot(args.tts_text, args.prompt_text, prompt_speech_16k, cosyvoice.sample_rate, '')
+    llm = cosyvoice.model.llm
+    # warmup
+    llm_inference(model_input)
+    for num_draft_tokens in [0] + args.num_draft_tokens:
+        llm.num_draft_tokens = num_draft_tokens
+        num_tokens, cost = 0, 0
+        llm.draft_stats = {'proposed': 0, 'accepted': 0, 'forward': 0}
+        for i in range(args.num_repeat):
+            set_all_random_seed(i)
+            start_time = time.time()
+            num_tokens += len(llm_inference(model_input))
+            cost += time.time() - start_time
+        stats = llm.draft_stats
+        print('num_draft_tokens {} speech tokens {} tokens/s {:.2f} acceptance rate {:.3f} tokens per target forward {:.2f}'.format(
+              num_draft_tokens, num_tokens / args.num_repeat, num_tokens / cost,
+              stats['accepted'] / max(stats['proposed'], 1), num_tokens / max(stats['forward'], 1) if num_draft_tokens > 0 else 1.0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice2-0.5B', help='must contain draft_llm in cosyvoice2.yaml and draft_llm.pt')
+    parser.add_argument('--prompt_wav', type=str, default='asset/zero_shot_prompt.wav')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--num_draft_tokens', type=int, nargs='+', default=[2, 4, 6])
+    parser.add_argument('--num_repeat', type=int, default=5)
+    parser.add_argument('--gpu', action='store_true', help='benchmark on gpu, default on cpu')
+    args = parser.parse_args()
+    if not args.gpu:
+        # cuda is initialized lazily, hide it before the model is built
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    cosyvoice = CosyVoice2(args.model_dir, num_draft_tokens=max(args.num_draft_tokens))
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    main(args)
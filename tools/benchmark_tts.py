@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+sys.path.append('third_party/Matcha-TTS')
+from cosyvoice.cli.cosyvoice import CosyVoice2
+from cosyvoice.utils.file_utils import load_wav
+from cosyvoice.utils.common import set_all_random_seed
+
+
+def single_job(i):
+    set_all_random_seed(i)
+    start_time = time.time()
+    first_packet_latency, speech_len = None, 0
+    for model_output in cosyvoice.inference_zero_shot(args.tts_text, args.prompt_text, prompt_speech_16k, stream=args.stream):
+        if first_packet_latency is None:
+            first_packet_latency = time.time() - start_time
+        speech_len += model_output['tts_speech'].shape[1] / cosyvoice.sample_rate
+    return time.time() - start_time, first_packet_latency, speech_len
+
+
+def main(args):
+    # warmup
+    single_job(0)
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(single_job, range(args.num_request)))
+    total_time = time.time() - start_time
+    latency = np.array([i[0] for i in results])
+    first_packet_latency = np.array([i[1] for i in results])
+    speech_len = np.array([i[2] for i in results])
+    print('concurrency {} num_request {} total time {:.3f}s'.format(args.concurrency, args.num_request, total_time))
+    print('first packet latency avg {:.3f}s p50 {:.3f}s p90 {:.3f}s'.format(first_packet_latency.mean(), np.percentile(first_packet_latency, 50),
+                                                                        np.percentile(first_packet_latency, 90)))
+    print('latency avg {:.3f}s p50 {:.3f}s p90 {:.3f}s'.format(latency.mean(), np.percentile(latency, 50), np.percentile(latency, 90)))
+    print('throughput {:.3f} speech seconds per second, avg rtf {:.3f}'.format(speech_len.sum() / total_time, (latency / speech_len).mean()))
+    print('llm decoding stopped by loop guard {}'.format(cosyvoice.model.llm.loop_stats))
+    if hasattr(cosyvoice.model.llm, 'scheduler'):
+        print('scheduler stats {}'.format(cosyvoice.model.llm.scheduler.stats()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice2-0.5B')
+    parser.add_argument('--prompt_wav', type=str, default='asset/zero_shot_prompt.wav')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--num_request', type=int, default=32)
+    parser.add_argument('--max_batch_size', type=int, default=1, help='>1 enables llm continuous batching, also flow/hift batch size of pipeline')
+    parser.add_argument('--num_kv_blocks', type=int, default=0, help='>0 keeps continuous batching kv cache in a paged pool of this many blocks')
+    parser.add_argument('--load_pipeline', action='store_true', help='overlap llm, flow and hift in a batched pipeline')
+    parser.add_argument('--stream', action='store_true')
+    args = parser.parse_args()
+
+    cosyvoice = CosyVoice2(args.model_dir, max_batch_size=args.max_batch_size, load_pipeline=args.load_pipeline, num_kv_blocks=args.num_kv_blocks)
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    main(args)
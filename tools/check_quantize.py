@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import os
+import sys
+import time
+import torch
+sys.path.append('third_party/Matcha-TTS')
+from cosyvoice.cli.cosyvoice import CosyVoice2
+from cosyvoice.utils.file_utils import load_wav
+from cosyvoice.utils.common import set_all_random_seed
+
+
+@torch.inference_mode()
+def llm_logp(llm, model_input, token):
+    # teacher forced logp of every speech token position given the same speech tokens
+    text = torch.concat([model_input['prompt_text'], model_input['text']], dim=1)
+    speech_token = torch.concat([model_input['llm_prompt_speech_token'], token], dim=1)
+    lm_input = torch.concat([llm.llm_embedding.weight[llm.sos_eos].reshape(1, 1, -1),
+                             llm.llm.model.model.embed_tokens(text),
+                             llm.llm_embedding.weight[llm.task_id].reshape(1, 1, -1),
+                             llm.speech_embedding(speech_token)], dim=1)
+    masks = torch.tril(torch.ones((1, lm_input.size(1), lm_input.size(1)))).to(torch.bool)
+    y_pred, _ = llm.llm.forward_one_step(lm_input, masks=masks, cache=None)
+    return llm.llm_decoder(y_pred[0, -token.size(1) - 1:]).log_softmax(dim=-1)
+
+
+@torch.inference_mode()
+def tts(model, model_input, token):
+    set_all_random_seed(0)
+    mel, _ = model.flow.inference(token=token,
+                                  token_len=torch.tensor([token.shape[1]], dtype=torch.int32),
+                                  prompt_token=model_input['flow_prompt_speech_token'],
+                                  prompt_token_len=model_input['flow_prompt_speech_token_len'],
+                                  prompt_feat=model_input['prompt_speech_feat'],
+                                  prompt_feat_len=model_input['prompt_speech_feat_len'],
+                                  embedding=model_input['flow_embedding'],
+                                  streaming=False,
+                                  finalize=True)
+    speech, _ = model.hift.inference(speech_feat=mel)
+    return mel, speech
+
+
+def timeit(func):
+    start_time = time.time()
+    for _ in range(args.num_repeat):
+        func()
+    return (time.time() - start_time) / args.num_repeat
+
+
+def main(args):
+    model_input = cosyvoice.frontend.frontend_zero_shot(args.tts_text, args.prompt_text, prompt_speech_16k, cosyvoice.sample_rate, '')
+    set_all_random_seed(0)
+    token = list(cosyvoice.model.llm.inference(text=model_input['text'],
+                                               text_len=model_input['text_len'],
+                                               prompt_text=model_input['prompt_text'],
+                                               prompt_text_len=model_input['prompt_text_len'],
+                                               prompt_speech_token=model_input['llm_prompt_speech_token'],
+                                               prompt_speech_token_len=model_input['llm_prompt_speech_token_len'],
+                                               embedding=model_input['llm_embedding']))
+    token = torch.tensor([token], dtype=torch.int32)
+    print('{} speech tokens generated by fp32 llm'.format(token.shape[1]))
+
+    # 1. llm, top-1 agreement and kl divergence of next token distributions
+    logp, logp_int8 = llm_logp(cosyvoice.model.llm, model_input, token), llm_logp(cosyvoice_int8.model.llm, model_input, token)
+    agreement = (logp.argmax(dim=-1) == logp_int8.argmax(dim=-1)).float().mean().item()
+    kl = (logp.exp() * (logp - logp_int8)).sum(dim=-1).mean().item()
+    cost = timeit(lambda: llm_logp(cosyvoice.model.llm, model_input, token))
+    cost_int8 = timeit(lambda: llm_logp(cosyvoice_int8.model.llm, model_input, token))
+    print('llm top-1 agreement {:.4f} kl {:.4f} forward time fp32 {:.3f}s int8 {:.3f}s'.format(agreement, kl, cost, cost_int8))
+
+    # 2. flow and hift, same tokens and same flow noise
+    mel, speech = tts(cosyvoice.model, model_input, token)
+    mel_int8, speech_int8 = tts(cosyvoice_int8.model, model_input, token)
+    snr = 10 * torch.log10(speech.pow(2).sum() / (speech - speech_int8).pow(2).sum()).item()
+    cost = timeit(lambda: tts(cosyvoice.model, model_input, token))
+    cost_int8 = timeit(lambda: tts(cosyvoice_int8.model, model_input, token))
+    print('flow mel l1 {:.4f} speech snr {:.2f}dB flow+hift time fp32 {:.3f}s int8 {:.3f}s'.format((mel - mel_int8).abs().mean().item(), snr, cost, cost_int8))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice2-0.5B')
+    parser.add_argument('--prompt_wav', type=str, default='asset/zero_shot_prompt.wav')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--num_repeat', type=int, default=3)
+    args = parser.parse_args()
+    # int8 dynamic quantization only runs on cpu, hide cuda before the models are built
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    cosyvoice = CosyVoice2(args.model_dir)
+    cosyvoice_int8 = CosyVoice2(args.model_dir, quantize='int8')
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    main(args)